@@ -0,0 +1,127 @@
+# coding=utf-8
+"""
+Micro-benchmark of Selector.match_class with a ~ClassName (inheritance)
+match, on a synthetic 10k widgets tree. Compares the previous
+implementation, resolving the bases of the class for every widget, with the
+per-class cache.
+
+Usage: python benchmarks/bench_match_class.py [nodes] [repeat]
+
+No PYTHONPATH is needed, nor ncis or Kivy: ncis_kivy is loaded from this
+checkout without running its __init__.py, which registers the routes and
+only works once ncis loaded the plugin.
+"""
+
+import os
+import sys
+import types
+import random
+from timeit import timeit
+
+if "ncis_kivy" not in sys.modules:
+    package = types.ModuleType("ncis_kivy")
+    package.__path__ = [os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "ncis_kivy")]
+    sys.modules["ncis_kivy"] = package
+
+from ncis_kivy.xpath import Selector, XpathParser, iter_tree  # noqa
+
+
+class Widget(object):
+    def __init__(self):
+        super(Widget, self).__init__()
+        self.parent = None
+        self.children = []
+
+    def add_widget(self, widget):
+        widget.parent = self
+        self.children.insert(0, widget)
+
+
+class Layout(Widget):
+    pass
+
+
+class BoxLayout(Layout):
+    pass
+
+
+class GridLayout(Layout):
+    pass
+
+
+class Label(Widget):
+    pass
+
+
+class ButtonBehavior(object):
+    pass
+
+
+class Button(ButtonBehavior, Label):
+    pass
+
+
+class ToggleButton(Button):
+    pass
+
+
+class TextInput(Widget):
+    pass
+
+
+def build_tree(nodes):
+    random.seed(0)
+    root = BoxLayout()
+    layouts = [root]
+    classes = (BoxLayout, GridLayout, Label, Button, ToggleButton, TextInput)
+    for _ in range(nodes - 1):
+        widget = random.choice(classes)()
+        random.choice(layouts).add_widget(widget)
+        if isinstance(widget, Layout):
+            layouts.append(widget)
+    return root
+
+
+def old_get_bases(cls):
+    for base in cls.__bases__:
+        if base.__name__ == 'object':
+            break
+        yield base
+        if base.__name__ == 'Widget':
+            break
+        for cbase in old_get_bases(base):
+            yield cbase
+
+
+def old_match_class(widget, classname):
+    if not classname.startswith("~"):
+        return widget.__class__.__name__ == classname
+    bases = [widget.__class__] + list(old_get_bases(widget.__class__))
+    bases = [cls.__name__ for cls in bases]
+    return classname[1:] in bases
+
+
+def main(nodes=10000, repeat=20):
+    root = build_tree(nodes)
+    widgets = list(iter_tree(root))
+    match_class = Selector().match_class
+    for classname in ("~Widget", "~Label", "~ButtonBehavior"):
+        expected = [old_match_class(w, classname) for w in widgets]
+        assert [match_class(w, classname) for w in widgets] == expected
+
+        old = timeit(lambda: [old_match_class(w, classname)
+                              for w in widgets], number=repeat)
+        new = timeit(lambda: [match_class(w, classname)
+                              for w in widgets], number=repeat)
+        print("{:<16} old {:8.2f}ms  new {:8.2f}ms  x{:.1f}".format(
+            classname, old * 1000 / repeat, new * 1000 / repeat, old / new))
+
+    selector = XpathParser().parse("//~Label")
+    new = timeit(lambda: selector.execute(root), number=repeat)
+    print("{:<16}                   new {:8.2f}ms".format(
+        "//~Label", new * 1000 / repeat))
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
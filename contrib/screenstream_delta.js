@@ -0,0 +1,119 @@
+/*
+ * Reference decoder for the NCIS Kivy delta screenstream
+ * (/kivy/screenstream/delta), drawing the stream into a canvas.
+ * The format is described in ncis_kivy/delta.py.
+ *
+ * Usage:
+ *   const stream = new NCISDeltaStream(canvas);
+ *   stream.open("http://device:8765/kivy/screenstream/delta");
+ *   ...
+ *   stream.close();
+ *
+ * Requires fetch streams and DecompressionStream ("deflate" being the
+ * zlib format).
+ */
+
+const NCIS_DELTA_MAGIC = 0x5444434e;  // "NCDT" read as little-endian
+const NCIS_DELTA_VERSION = 1;
+const NCIS_DELTA_KEYFRAME = 1;
+const NCIS_DELTA_HEADER_SIZE = 24;
+
+class NCISDeltaStream {
+  constructor(canvas) {
+    this.canvas = canvas;
+    this.ctx = canvas.getContext("2d");
+    this.seq = null;
+    this.controller = null;
+  }
+
+  async open(url) {
+    this.controller = new AbortController();
+    const response = await fetch(url, {signal: this.controller.signal});
+    const reader = response.body.getReader();
+    let buf = new Uint8Array(0);
+    for (;;) {
+      const {done, value} = await reader.read();
+      if (done) {
+        return;
+      }
+      buf = concat(buf, value);
+      // split the length prefixed messages
+      while (buf.length >= 4) {
+        const length = new DataView(buf.buffer, buf.byteOffset).getUint32(
+          0, true);
+        if (buf.length < 4 + length) {
+          break;
+        }
+        await this.feed(buf.slice(4, 4 + length));
+        buf = buf.slice(4 + length);
+      }
+    }
+  }
+
+  close() {
+    if (this.controller) {
+      this.controller.abort();
+    }
+  }
+
+  async feed(compressed) {
+    const payload = await inflate(compressed);
+    const view = new DataView(payload.buffer, payload.byteOffset);
+    if (view.getUint32(0, true) !== NCIS_DELTA_MAGIC ||
+        view.getUint8(4) !== NCIS_DELTA_VERSION) {
+      throw new Error("Invalid delta message");
+    }
+    const kind = view.getUint8(5);
+    const tile = view.getUint16(6, true);
+    const width = view.getUint32(8, true);
+    const height = view.getUint32(12, true);
+    const seq = view.getUint32(16, true);
+    const count = view.getUint32(20, true);
+
+    if (kind === NCIS_DELTA_KEYFRAME &&
+        (this.canvas.width !== width || this.canvas.height !== height)) {
+      this.canvas.width = width;
+      this.canvas.height = height;
+    }
+
+    let offset = NCIS_DELTA_HEADER_SIZE;
+    for (let i = 0; i < count; i++) {
+      const tx = view.getUint16(offset, true);
+      const ty = view.getUint16(offset + 2, true);
+      offset += 4;
+      const x = tx * tile;
+      const y = ty * tile;
+      const tw = Math.min(tile, width - x);
+      const th = Math.min(tile, height - y);
+      // RGB to RGBA
+      const image = this.ctx.createImageData(tw, th);
+      for (let src = offset, dst = 0; dst < image.data.length;
+           src += 3, dst += 4) {
+        image.data[dst] = payload[src];
+        image.data[dst + 1] = payload[src + 1];
+        image.data[dst + 2] = payload[src + 2];
+        image.data[dst + 3] = 255;
+      }
+      this.ctx.putImageData(image, x, y);
+      offset += tw * th * 3;
+    }
+    this.seq = seq;
+  }
+}
+
+function concat(a, b) {
+  const out = new Uint8Array(a.length + b.length);
+  out.set(a, 0);
+  out.set(b, a.length);
+  return out;
+}
+
+async function inflate(data) {
+  const stream = new Blob([data]).stream().pipeThrough(
+    new DecompressionStream("deflate"));
+  return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+if (typeof module !== "undefined") {
+  module.exports = {NCISDeltaStream};
+}
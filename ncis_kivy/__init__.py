@@ -8,4 +8,5 @@ __author__ = (
 # register some routes
 import ncis_kivy.routes.query  # noqa
 import ncis_kivy.routes.screenstream  # noqa
+import ncis_kivy.routes.metrics  # noqa
 
@@ -0,0 +1,176 @@
+# coding=utf-8
+"""
+Delta screenstream
+==================
+
+Encode consecutive captures as the tiles that changed since the previous
+one, for the `/screenstream/delta` route. Requires NumPy.
+
+The stream is a sequence of messages, each one being a little-endian
+`uint32` length followed by a zlib compressed payload::
+
+    header   4s   magic "NCDT"
+             B    version (1)
+             B    kind, 1 for a keyframe (all the tiles), 2 for a delta
+             H    tile size
+             I    width
+             I    height
+             I    frame sequence number
+             I    number of tiles
+    tiles    H H  tile column and row, then the RGB pixels of the tile, top
+                  to bottom. Tiles on the right and bottom edges may be
+                  smaller than the tile size.
+
+A delta with no tiles is sent as a keepalive. `DeltaDecoder` is the
+reference decoder, contrib/screenstream_delta.js is the one for browsers.
+"""
+
+import struct
+import zlib
+import numpy as np
+
+MAGIC = b"NCDT"
+VERSION = 1
+KEYFRAME = 1
+DELTA = 2
+HEADER = struct.Struct("<4sBBHIIII")
+TILE = struct.Struct("<HH")
+LENGTH = struct.Struct("<I")
+
+
+def frame_to_array(width, height, pixels, flipped):
+    """Return the pixels as a top-down (height, width, 3) array.
+    """
+    image = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width, 3)
+    if flipped:
+        image = image[::-1]
+    return image
+
+
+def changed_tiles(previous, image, tile):
+    """Return a (rows, columns) boolean array of the tiles that differ
+    between two images of the same size.
+    """
+    height, width = image.shape[:2]
+    rows = -(-height // tile)
+    columns = -(-width // tile)
+    changed = np.zeros((rows * tile, columns * tile), dtype=bool)
+    changed[:height, :width] = np.any(previous != image, axis=2)
+    return changed.reshape(rows, tile, columns, tile).any(axis=(1, 3))
+
+
+class DeltaEncoder(object):
+    """Encode the frames of one client. The first frame, and then one every
+    `keyframe_interval` seconds, is a keyframe.
+    """
+
+    def __init__(self, tile=32, keyframe_interval=10., level=1):
+        super(DeltaEncoder, self).__init__()
+        self.tile = tile
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self._previous = None
+        self._last_keyframe = None
+
+    def encode(self, seq, timestamp, width, height, pixels, flipped):
+        """Return the message for this frame, or None if nothing changed.
+        """
+        image = frame_to_array(width, height, pixels, flipped)
+        previous = self._previous
+        keyframe = (
+            previous is None or previous.shape != image.shape or
+            timestamp - self._last_keyframe >= self.keyframe_interval)
+
+        tile = self.tile
+        if keyframe:
+            rows = -(-height // tile)
+            columns = -(-width // tile)
+            changed = np.ones((rows, columns), dtype=bool)
+            self._last_keyframe = timestamp
+        else:
+            changed = changed_tiles(previous, image, tile)
+            if not changed.any():
+                return
+        self._previous = image
+
+        kind = KEYFRAME if keyframe else DELTA
+        ys, xs = np.nonzero(changed)
+        parts = [HEADER.pack(MAGIC, VERSION, kind, tile, width, height,
+                             seq, len(ys))]
+        for ty, tx in zip(ys.tolist(), xs.tolist()):
+            parts.append(TILE.pack(tx, ty))
+            parts.append(image[ty * tile:(ty + 1) * tile,
+                               tx * tile:(tx + 1) * tile].tobytes())
+        return self._message(b"".join(parts))
+
+    def keepalive(self, seq):
+        if self._previous is None:
+            return
+        height, width = self._previous.shape[:2]
+        return self._message(HEADER.pack(
+            MAGIC, VERSION, DELTA, self.tile, width, height, seq, 0))
+
+    def _message(self, payload):
+        payload = zlib.compress(payload, self.level)
+        return LENGTH.pack(len(payload)) + payload
+
+
+class DeltaDecoder(object):
+    """Reference decoder, rebuilding the top-down RGB image.
+    """
+
+    def __init__(self):
+        super(DeltaDecoder, self).__init__()
+        self.image = None
+        self.seq = None
+
+    def feed(self, payload):
+        """Apply one message payload (without its length prefix) and return
+        the image.
+        """
+        payload = zlib.decompress(payload)
+        magic, version, kind, tile, width, height, seq, count = \
+            HEADER.unpack_from(payload)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Invalid delta message")
+        if kind == KEYFRAME or self.image is None or \
+                self.image.shape != (height, width, 3):
+            if kind != KEYFRAME:
+                raise ValueError("Delta message without keyframe")
+            self.image = np.zeros((height, width, 3), dtype=np.uint8)
+
+        offset = HEADER.size
+        for _ in range(count):
+            tx, ty = TILE.unpack_from(payload, offset)
+            offset += TILE.size
+            x, y = tx * tile, ty * tile
+            tw = min(tile, width - x)
+            th = min(tile, height - y)
+            size = tw * th * 3
+            self.image[y:y + th, x:x + tw] = np.frombuffer(
+                payload, dtype=np.uint8, count=size,
+                offset=offset).reshape(th, tw, 3)
+            offset += size
+        self.seq = seq
+        return self.image
+
+
+def iter_messages(read):
+    """Split a stream into message payloads, `read(n)` being a function
+    returning up to n bytes, like `file.read`.
+    """
+    buf = b""
+    while True:
+        while len(buf) < LENGTH.size:
+            data = read(65536)
+            if not data:
+                return
+            buf += data
+        length = LENGTH.unpack_from(buf)[0]
+        while len(buf) < LENGTH.size + length:
+            data = read(65536)
+            if not data:
+                return
+            buf += data
+        yield buf[LENGTH.size:LENGTH.size + length]
+        buf = buf[LENGTH.size + length:]
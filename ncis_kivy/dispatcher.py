@@ -0,0 +1,152 @@
+# coding=utf-8
+"""
+Main thread dispatcher
+======================
+
+Run callables from the HTTP threads on the Kivy thread. Submitted calls go
+to a single queue, drained once per Clock frame by a trigger, so many calls
+submitted at once run in the same tick. Each call returns a
+`concurrent.futures.Future` with its return value or exception.
+"""
+
+import threading
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from time import time
+from ncis_kivy.metrics import span, record
+
+
+class LatencyHistogram(object):
+    """Histogram of latencies in seconds, with the upper bound of each
+    bucket, and a last bucket for the larger ones.
+    """
+
+    BOUNDS = (.001, .002, .005, .01, .02, .05, .1, .2, .5, 1., 2., 5.)
+
+    def __init__(self, bounds=BOUNDS):
+        super(LatencyHistogram, self).__init__()
+        self.bounds = bounds
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.bounds) + 1)
+            self.count = 0
+            self.sum = 0.
+            self.max = 0.
+
+    def record(self, value):
+        with self._lock:
+            self._counts[bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def snapshot(self):
+        """Return the cumulative counts as [upper bound, count], the last
+        bound being "+Inf", like Prometheus histograms.
+        """
+        with self._lock:
+            buckets = []
+            total = 0
+            bounds = list(self.bounds) + ["+Inf"]
+            for bound, count in zip(bounds, self._counts):
+                total += count
+                buckets.append([bound, total])
+            return {
+                "buckets": buckets,
+                "count": self.count,
+                "sum": self.sum,
+                "max": self.max,
+            }
+
+
+class MainThreadDispatcher(object):
+    def __init__(self):
+        super(MainThreadDispatcher, self).__init__()
+        # deque append and popleft are thread safe
+        self._queue = deque()
+        self._trigger = None
+        self._lock = threading.Lock()
+        self.latency = LatencyHistogram()
+        self.submitted = 0
+        self.inline = 0
+        self.ticks = 0
+        self.max_batch = 0
+
+    def submit(self, f, *args, **kwargs):
+        """Schedule `f(*args, **kwargs)` on the Kivy thread and return its
+        future. Called from the Kivy thread, `f` runs immediately.
+        """
+        future = Future()
+        if threading.current_thread().name == "MainThread":
+            self.inline += 1
+            self._run(future, f, args, kwargs)
+            return future
+        self._queue.append((future, f, args, kwargs, time()))
+        self.submitted += 1
+        self._get_trigger()()
+        return future
+
+    def call(self, f, args=(), kwargs=None, timeout=None):
+        """Run `f` on the Kivy thread and return its result, or raise its
+        exception. Raise `TimeoutError` if it did not complete within
+        `timeout` seconds, and cancel it if it did not start yet.
+        """
+        future = self.submit(f, *args, **(kwargs or {}))
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def _get_trigger(self):
+        with self._lock:
+            if self._trigger is None:
+                from kivy.clock import Clock
+                self._trigger = Clock.create_trigger(self._drain, 0)
+            return self._trigger
+
+    def _drain(self, dt):
+        queue = self._queue
+        count = 0
+        # only the calls queued so far, later ones triggered the next frame
+        for _ in range(len(queue)):
+            future, f, args, kwargs, queued = queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            latency = time() - queued
+            self.latency.record(latency)
+            record("dispatch_wait", latency)
+            count += 1
+            with span("dispatch_run"):
+                self._run(future, f, args, kwargs, running=True)
+        self.ticks += 1
+        self.max_batch = max(self.max_batch, count)
+
+    def _run(self, future, f, args, kwargs, running=False):
+        if not running and not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = f(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        return {
+            "pending": len(self._queue),
+            "submitted": self.submitted,
+            "inline": self.inline,
+            "ticks": self.ticks,
+            "max_batch": self.max_batch,
+            "latency": self.latency.snapshot(),
+        }
+
+
+dispatcher = MainThreadDispatcher()
@@ -0,0 +1,341 @@
+# coding=utf-8
+"""
+Widget index
+============
+
+Optional index of the live widget tree, mapping class names (and the names
+of their bases, for ~ClassName) to weak sets of widgets. It is maintained
+incrementally by watching the `children` of every indexed widget, so
+//ClassName steps can resolve their candidates without a full traversal.
+"""
+
+import weakref
+from collections import defaultdict, deque
+from threading import Condition, Lock
+from ncis_kivy.xpath import class_names, iter_tree
+
+widget_index = None
+tree_journal = None
+
+
+def sibling_positions(children):
+    """Map the id of each child to its position, the first one for a child
+    listed twice, like `children.index`.
+    """
+    positions = {}
+    for position, child in enumerate(children):
+        positions.setdefault(id(child), position)
+    return positions
+
+
+class WidgetIndex(object):
+    #: classes matching more than this fraction of the indexed widgets are
+    #: not looked up: walking the branches leading to so many candidates
+    #: is slower than walking the whole tree
+    LOOKUP_MAX_FRACTION = .2
+
+    def __init__(self, root, debug=False):
+        super(WidgetIndex, self).__init__()
+        self.root = root
+        self.debug = debug
+        self.inconsistencies = 0
+        # called with a change dict for every structural change, see
+        # TreeJournal
+        self.listeners = []
+        self._lock = Lock()
+        self._classes = defaultdict(weakref.WeakSet)
+        # class name -> {id: widget} returned by lookup, until it changes
+        self._lookups = {}
+        # id(widget) -> (binding uid, children as last seen)
+        self._watched = {}
+        # id(widget) -> (children the positions were built from, positions)
+        self._siblings = {}
+        self._add(root)
+
+    def _add(self, widget):
+        with self._lock:
+            for node in iter_tree(widget):
+                key = id(node)
+                if key in self._watched:
+                    continue
+                for name in class_names(node.__class__):
+                    self._classes[name].add(node)
+                    self._lookups.pop(name, None)
+                uid = node.fbind("children", self._on_children)
+                self._watched[key] = (uid, tuple(node.children))
+
+    def _remove(self, widget):
+        with self._lock:
+            stack = [widget]
+            while stack:
+                node = stack.pop()
+                entry = self._watched.pop(id(node), None)
+                if entry is None:
+                    continue
+                uid, children = entry
+                self._siblings.pop(id(node), None)
+                node.unbind_uid("children", uid)
+                for name in class_names(node.__class__):
+                    self._classes[name].discard(node)
+                    self._lookups.pop(name, None)
+                stack.extend(children)
+
+    def _on_children(self, widget, children):
+        entry = self._watched.get(id(widget))
+        if entry is None:
+            return
+        uid, old_children = entry
+        old_ids = set(map(id, old_children))
+        new_ids = set(map(id, children))
+        for child in old_children:
+            if id(child) not in new_ids:
+                self._remove(child)
+                self._notify({"op": "remove", "parent": widget,
+                              "child": child})
+        with self._lock:
+            self._watched[id(widget)] = (uid, tuple(children))
+        for position, child in enumerate(children):
+            if id(child) not in old_ids:
+                self._add(child)
+                self._notify_added(widget, child, position)
+
+        # the children kept changed order
+        kept_before = [id(child) for child in old_children
+                       if id(child) in new_ids]
+        kept_after = [id(child) for child in children if id(child) in old_ids]
+        if kept_before != kept_after:
+            self._notify({"op": "reorder", "parent": widget,
+                          "children": list(children)})
+
+    def _notify(self, change):
+        for listener in self.listeners:
+            listener(change)
+
+    def _notify_added(self, parent, child, position):
+        if not self.listeners:
+            return
+        self._notify({"op": "add", "parent": parent, "child": child,
+                      "index": position})
+        # then its subtree, parents before their children
+        for node in iter_tree(child):
+            for position, grandchild in enumerate(node.children):
+                self._notify({"op": "add", "parent": node,
+                              "child": grandchild, "index": position})
+
+    def uninstall(self):
+        self._remove(self.root)
+
+    def lookup(self, classname, root):
+        """Return the widgets (by id) that may match `classname` under `root`,
+        or None if `root` is not indexed or if the class is too common for
+        the index to help, the tree is walked then. The result must not be
+        modified.
+        """
+        name = classname[1:] if classname.startswith("~") else classname
+        with self._lock:
+            if id(root) not in self._watched:
+                return None
+            indexed = self._classes.get(name, ())
+            if len(indexed) > self.LOOKUP_MAX_FRACTION * len(self._watched):
+                return None
+            widgets = self._lookups.get(name)
+            if widgets is None:
+                widgets = self._lookups[name] = {
+                    id(widget): widget for widget in list(indexed)}
+            return widgets
+
+    def siblings(self, parent):
+        """Return the positions of the children of `parent`, see
+        `sibling_positions`, or None if `parent` is not indexed. Cached until
+        its children change.
+        """
+        with self._lock:
+            entry = self._watched.get(id(parent))
+            if entry is None:
+                return None
+            children = entry[1]
+            cached = self._siblings.get(id(parent))
+            if cached is not None and cached[0] is children:
+                return cached[1]
+            positions = sibling_positions(children)
+            self._siblings[id(parent)] = (children, positions)
+            return positions
+
+    def inconsistent(self, selector, expected, indexed):
+        from kivy.logger import Logger
+        self.inconsistencies += 1
+        Logger.warning(
+            "NCIS: index inconsistent for {!r}: {} widgets found by "
+            "traversal, {} by the index".format(
+                selector, len(expected), len(indexed)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "widgets": len(self._watched),
+                "classes": len(self._classes),
+                "debug": self.debug,
+                "inconsistencies": self.inconsistencies,
+            }
+
+
+class TreeSnapshot(object):
+    """Class-name index built with a single walk of the tree, and not
+    maintained afterwards. Used to serve many selectors from the same tick.
+    """
+
+    debug = False
+
+    def __init__(self, root):
+        super(TreeSnapshot, self).__init__()
+        self.root = root
+        self._ids = set()
+        self._classes = defaultdict(dict)
+        self._siblings = {}
+        for node in iter_tree(root):
+            self._ids.add(id(node))
+            for name in class_names(node.__class__):
+                self._classes[name][id(node)] = node
+
+    def lookup(self, classname, root):
+        name = classname[1:] if classname.startswith("~") else classname
+        if id(root) not in self._ids:
+            return None
+        widgets = self._classes.get(name, {})
+        if len(widgets) > WidgetIndex.LOOKUP_MAX_FRACTION * len(self._ids):
+            return None
+        return widgets
+
+    def siblings(self, parent):
+        if id(parent) not in self._ids:
+            return None
+        positions = self._siblings.get(id(parent))
+        if positions is None:
+            positions = self._siblings[id(parent)] = \
+                sibling_positions(parent.children)
+        return positions
+
+
+def change_ids(change):
+    """Replace the widgets of a change by their ids.
+    """
+    result = {}
+    for key, value in change.items():
+        if key in ("parent", "child"):
+            value = id(value)
+        elif key == "children":
+            value = [id(child) for child in value]
+        result[key] = value
+    return result
+
+
+class TreeJournal(object):
+    """Bounded log of the structural changes of the indexed tree, each one
+    numbered with a revision, for clients to stay in sync with only the
+    changes since the revision they know.
+
+    The widgets of a change are recorded as their ids, see `change_ids`,
+    which are the `original_id` of the widgets sent by /tree. The child of
+    an `add` change is also kept as a weak reference, returned as `widget`
+    by `since`. Recording does no serialisation and doesn't keep the
+    removed widgets alive.
+    """
+
+    def __init__(self, index, revision=0, maxlen=1000):
+        super(TreeJournal, self).__init__()
+        self.index = index
+        self.revision = revision
+        # changes older than this revision are lost
+        self._base = revision
+        # (change, weak reference to the added widget or None)
+        self._changes = deque(maxlen=maxlen)
+        self._cond = Condition()
+        index.listeners.append(self.record)
+
+    def record(self, change):
+        ref = weakref.ref(change["child"]) if change["op"] == "add" else None
+        change = change_ids(change)
+        with self._cond:
+            self.revision += 1
+            change["revision"] = self.revision
+            if len(self._changes) == self._changes.maxlen:
+                self._base = self._changes[0][0]["revision"]
+            self._changes.append((change, ref))
+            self._cond.notify_all()
+
+    def since(self, revision):
+        """Return the current revision and the changes after `revision`, or
+        None if they are not all known anymore and the client must reload
+        the whole tree. `add` changes get the added `widget`, None if it was
+        collected since.
+        """
+        with self._cond:
+            if revision is None or not \
+                    self._base <= revision <= self.revision:
+                return None
+            changes = [(change, ref) for change, ref in self._changes
+                       if change["revision"] > revision]
+            current = self.revision
+        results = []
+        for change, ref in changes:
+            change = dict(change)
+            if ref is not None:
+                change["widget"] = ref()
+            results.append(change)
+        return current, results
+
+    def wait(self, revision, timeout=None):
+        """Wait up to `timeout` seconds for a revision after `revision`.
+        """
+        # not imported at the top, ncis_kivy.utils imports this module
+        from ncis_kivy.utils import wait_until
+        with self._cond:
+            return wait_until(
+                self._cond, lambda: self.revision != revision, timeout)
+
+    def detach(self):
+        if self.record in self.index.listeners:
+            self.index.listeners.remove(self.record)
+
+
+def current_index():
+    return widget_index
+
+
+def index_install(debug=False):
+    """Index the whole Window tree. Must be called from the Kivy thread.
+    """
+    global widget_index
+    from kivy.core.window import Window
+    if widget_index is not None:
+        widget_index.debug = debug
+        return widget_index
+    widget_index = WidgetIndex(Window, debug=debug)
+    return widget_index
+
+
+def index_uninstall():
+    """Must be called from the Kivy thread.
+    """
+    global widget_index
+    if widget_index is not None:
+        widget_index.uninstall()
+        widget_index = None
+
+
+def current_journal():
+    """Return the journal of the tree changes, or None.
+    """
+    return tree_journal
+
+
+def journal_install():
+    """Journal the changes of the tree. The journal has an index of its own,
+    so the selectors keep walking the tree unless the index is installed
+    too. Must be called from the Kivy thread.
+    """
+    global tree_journal
+    from kivy.core.window import Window
+    if tree_journal is None:
+        tree_journal = TreeJournal(WidgetIndex(Window))
+    return tree_journal
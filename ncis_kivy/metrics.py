@@ -0,0 +1,144 @@
+# coding=utf-8
+"""
+Metrics
+=======
+
+Durations of named spans, to find out where the time of a request goes:
+
+- `parse`: compiling a selector (cache misses only)
+- `traverse`: evaluating a selector against the tree
+- `path_build`: building the paths of the results
+- `dispatch_wait`: time a call waited for the Kivy thread
+- `dispatch_run`: time a call ran on the Kivy thread
+- `readback`: reading the pixels of the window
+- `encode`: encoding a frame
+
+Each span keeps its count and total, and a window of its last durations for
+the percentiles. Disabled by default (or enabled with the NCIS_KIVY_METRICS
+environment variable): `span()` then returns a shared object doing nothing,
+and `record()` returns immediately.
+"""
+
+import os
+from collections import deque
+from threading import Lock
+from time import time
+
+QUANTILES = (.5, .9, .99)
+
+
+class SpanStats(object):
+    def __init__(self, window=1024):
+        super(SpanStats, self).__init__()
+        self.count = 0
+        self.sum = 0.
+        self.durations = deque(maxlen=window)
+
+    def quantiles(self):
+        durations = sorted(self.durations)
+        if not durations:
+            return {}
+        last = len(durations) - 1
+        return {q: durations[int(round(q * last))] for q in QUANTILES}
+
+
+class Metrics(object):
+    def __init__(self, enabled=False, window=1024):
+        super(Metrics, self).__init__()
+        self.enabled = enabled
+        self.window = window
+        self._spans = {}
+        self._lock = Lock()
+
+    def record(self, name, duration):
+        if not self.enabled:
+            return
+        with self._lock:
+            stats = self._spans.get(name)
+            if stats is None:
+                stats = self._spans[name] = SpanStats(self.window)
+            stats.count += 1
+            stats.sum += duration
+            stats.durations.append(duration)
+
+    def reset(self):
+        with self._lock:
+            self._spans = {}
+
+    def snapshot(self):
+        """Return {name: {count, sum, quantiles}}.
+        """
+        with self._lock:
+            return {
+                name: {
+                    "count": stats.count,
+                    "sum": stats.sum,
+                    "quantiles": stats.quantiles(),
+                }
+                for name, stats in self._spans.items()
+            }
+
+    def prometheus(self):
+        """Return the spans in the Prometheus text format, as a summary.
+        """
+        lines = [
+            "# HELP ncis_kivy_span_seconds Duration of the NCIS Kivy "
+            "operations.",
+            "# TYPE ncis_kivy_span_seconds summary",
+        ]
+        for name, stats in sorted(self.snapshot().items()):
+            for q, value in sorted(stats["quantiles"].items()):
+                lines.append(
+                    'ncis_kivy_span_seconds{{span="{}",quantile="{}"}} '
+                    '{!r}'.format(name, q, value))
+            lines.append('ncis_kivy_span_seconds_sum{{span="{}"}} {!r}'.format(
+                name, stats["sum"]))
+            lines.append('ncis_kivy_span_seconds_count{{span="{}"}} {}'.format(
+                name, stats["count"]))
+        lines.append("# HELP ncis_kivy_metrics_enabled Whether the spans are "
+                     "recorded.")
+        lines.append("# TYPE ncis_kivy_metrics_enabled gauge")
+        lines.append("ncis_kivy_metrics_enabled {}".format(
+            int(self.enabled)))
+        return "\n".join(lines) + "\n"
+
+
+class Span(object):
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *exc):
+        metrics.record(self.name, time() - self.start)
+
+
+class NoopSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_noop_span = NoopSpan()
+
+metrics = Metrics(enabled=bool(os.environ.get("NCIS_KIVY_METRICS")))
+
+
+def span(name):
+    """Context manager timing the span `name`.
+    """
+    if not metrics.enabled:
+        return _noop_span
+    return Span(name)
+
+
+def record(name, duration):
+    metrics.record(name, duration)
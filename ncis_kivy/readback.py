@@ -0,0 +1,134 @@
+# coding=utf-8
+"""
+Window readback
+===============
+
+Read the pixels of the window at the end of a frame, for the screenstream.
+
+- `SyncReadback` does a blocking `glReadPixels`, the pixels are bottom-up.
+- `PBOReadback` reads into two pixel buffer objects used in turn: the
+  `glReadPixels` of frame N returns immediately, and its buffer is mapped
+  during the flip of frame N+1, so frames come out one frame late. The rows
+  are reversed while copying out of the mapped buffer, so the pixels are
+  top-down and the encoder doesn't need to flip them.
+
+Kivy's own GL bindings target GLES2, which has no pixel pack buffers, so
+`PBOReadback` goes through PyOpenGL. It only depends on a current GL
+context, and can be tested under a headless Mesa context.
+"""
+
+import ctypes
+
+
+class SyncReadback(object):
+    flipped = True
+    delayed = False
+
+    def read(self, width, height):
+        """Return the pixels of the current frame.
+        """
+        from kivy.graphics.opengl import (
+            glReadPixels, GL_RGB, GL_UNSIGNED_BYTE)
+        return glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
+
+    def reset(self):
+        pass
+
+
+class PBOReadback(object):
+    flipped = False
+    delayed = True
+
+    def __init__(self):
+        super(PBOReadback, self).__init__()
+        from OpenGL import GL
+        self.GL = GL
+        self._pbos = [int(pbo) for pbo in GL.glGenBuffers(2)]
+        self._size = None
+        self._index = 0
+        # index of the buffer holding the previous frame
+        self._pending = None
+
+    def _allocate(self, width, height):
+        GL = self.GL
+        for pbo in self._pbos:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, pbo)
+            GL.glBufferData(GL.GL_PIXEL_PACK_BUFFER, width * height * 3,
+                            None, GL.GL_STREAM_READ)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+        self._size = (width, height)
+        self._pending = None
+
+    def read(self, width, height):
+        """Start the readback of the current frame, and return the pixels of
+        the previous one, or None if there is none yet (first frame, or the
+        window was resized).
+        """
+        GL = self.GL
+        if self._size != (width, height):
+            self._allocate(width, height)
+
+        # restored afterwards, the other glReadPixels depend on it
+        alignment = int(GL.glGetIntegerv(GL.GL_PACK_ALIGNMENT))
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, self._pbos[self._index])
+        try:
+            GL.glReadPixels(0, 0, width, height, GL.GL_RGB,
+                            GL.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+            pixels = None
+            if self._pending is not None:
+                pixels = self._map(self._pbos[self._pending], width, height)
+        finally:
+            GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, 0)
+            GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, alignment)
+
+        self._pending = self._index
+        self._index = 1 - self._index
+        return pixels
+
+    def _map(self, pbo, width, height):
+        GL = self.GL
+        stride = width * 3
+        size = stride * height
+        GL.glBindBuffer(GL.GL_PIXEL_PACK_BUFFER, pbo)
+        address = GL.glMapBuffer(GL.GL_PIXEL_PACK_BUFFER, GL.GL_READ_ONLY)
+        if not address:
+            return
+        try:
+            mapped = memoryview(
+                (ctypes.c_ubyte * size).from_address(address)).cast("B")
+            # the copy out of the mapping is needed anyway, reverse the
+            # rows while doing it
+            pixels = bytearray(size)
+            for y in range(height):
+                offset = (height - 1 - y) * stride
+                pixels[y * stride:(y + 1) * stride] = \
+                    mapped[offset:offset + stride]
+        finally:
+            GL.glUnmapBuffer(GL.GL_PIXEL_PACK_BUFFER)
+        return bytes(pixels)
+
+    def reset(self):
+        """Drop the pending frame, i.e. when the capture restarts.
+        """
+        self._pending = None
+
+    def release(self):
+        self.GL.glDeleteBuffers(2, self._pbos)
+        self._pbos = []
+
+
+def readback_create(mode):
+    """Create the readback for `mode`, "sync" or "pbo". Fall back to the
+    synchronous readback if pixel buffer objects are not available. Must be
+    called with the GL context current.
+    """
+    if mode == "pbo":
+        try:
+            return PBOReadback()
+        except Exception as e:
+            from kivy.logger import Logger
+            Logger.warning(
+                "NCIS: pixel buffer objects unavailable ({}), using the "
+                "synchronous readback".format(e))
+    return SyncReadback()
@@ -0,0 +1,52 @@
+"""
+Metrics routes
+==============
+
+Expose the timing spans of :mod:`ncis_kivy.metrics` and the dispatcher
+queue latency, for Prometheus or for a quick look.
+"""
+
+from ncis import route, api_response, request
+from ncis_kivy.metrics import metrics
+from ncis_kivy.dispatcher import dispatcher
+from flask import Response
+
+
+@route('/metrics')
+def kivy_metrics():
+    """Prometheus text format: the spans as summaries, with rolling
+    percentiles, and the dispatcher queue latency as a histogram.
+    """
+    lines = [metrics.prometheus()]
+    latency = dispatcher.latency.snapshot()
+    lines.append(
+        "# HELP ncis_kivy_dispatch_queue_seconds Time calls waited for the "
+        "Kivy thread.\n"
+        "# TYPE ncis_kivy_dispatch_queue_seconds histogram\n")
+    for bound, count in latency["buckets"]:
+        lines.append(
+            'ncis_kivy_dispatch_queue_seconds_bucket{{le="{}"}} {}\n'.format(
+                bound, count))
+    lines.append("ncis_kivy_dispatch_queue_seconds_sum {!r}\n".format(
+        latency["sum"]))
+    lines.append("ncis_kivy_dispatch_queue_seconds_count {}\n".format(
+        latency["count"]))
+    return Response(''.join(lines),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@route('/metrics/config', methods=['GET', 'POST'])
+def kivy_metrics_config():
+    """Enable or disable the spans with `enabled`, clear them with `reset`.
+    Returns the spans as JSON.
+    """
+    if request.method == 'POST':
+        enabled = request.form.get('enabled')
+        if enabled is not None:
+            metrics.enabled = enabled not in ('', '0', 'false')
+        if request.form.get('reset'):
+            metrics.reset()
+    return api_response({
+        'enabled': metrics.enabled,
+        'spans': metrics.snapshot(),
+    })
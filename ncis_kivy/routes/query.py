@@ -5,18 +5,36 @@ Query routes
 Handle everything related to Kivy pick, set, search.
 """
 
-from ncis import route, api_response, request, ncis_weakrefs, api_error
-from ncis_kivy.xpath import XpathParser
-from ncis_kivy.utils import kivyapp, kivythread
+from ncis import (
+    route, api_response, request, ncis_weakrefs, api_error, jsonify)
+from ncis_kivy.xpath import (
+    xpath_cache, compile_xpath, observe_attributes, AttrOpSelector,
+    AttrExistSelector)
+from ncis_kivy.dispatcher import dispatcher
+from ncis_kivy.index import (
+    current_index, index_install, index_uninstall, TreeSnapshot,
+    WidgetIndex, current_journal, journal_install)
+from ncis_kivy.utils import (
+    kivyapp, kivythread, select_all, select_first, widget_bounds,
+    widget_paths, pick_at, wait_until)
 from flask import Response, abort
 from time import sleep
 from itertools import count
+from collections import deque
+from heapq import heappush, heappop
 import traceback
 import threading
+import weakref
 import kivy
+import json
 import io
 import re
 
+try:
+    unichr
+except NameError:  # Python 3
+    unichr = chr
+
 
 
 @route('/version')
@@ -28,21 +46,187 @@ def kivy_version():
 
 @route('/tree')
 def tree():
+    """Tree of the widgets, as nested (widget, children) pairs. Optional
+    parameters: `root`, a widget id or a selector, `depth`, the number of
+    levels to return, and `fields`, comma separated attributes to add to
+    each node as (widget, children, {field: value}). With `stream`, the
+    nodes are streamed in document order as JSON lines
+    `{"widget", "parent", "depth", "fields"}`.
+    """
     from kivy.core.window import Window
+    args = request.args
+    depth = args.get('depth', type=int)
+    fields = _fields_arg()
+
+    root = args.get('root')
+    if not root:
+        root, label = Window, 'root'
+    else:
+        if root.isdigit():
+            ref = ncis_weakrefs.get(int(root))
+            root = ref() if ref is not None else None
+        else:
+            root = select_first(root)
+        if root is None:
+            return api_error('Invalid `root`')
+        label = root
+
+    if args.get('stream'):
+        def _stream():
+            for widget, parent, level in _iter_tree_nodes(root, depth):
+                node = {'widget': widget, 'parent': parent, 'depth': level}
+                if fields:
+                    node['fields'] = _tree_fields(widget, fields)
+                yield jsonify(node, get_response=False) + '\n'
+
+        return Response(_stream(), mimetype='application/x-ndjson')
+
     return api_response({
-        'tree': ('root', _tree(Window))
+        'tree': (label, _tree(root, depth, fields))
     })
 
 
-def _tree(root):
+def _fields_arg():
+    fields = request.args.get('fields')
+    if fields:
+        return [field for field in fields.split(',') if field]
+
+
+def _json_arg(name):
+    """Return the `name` argument, from the JSON body (the body itself, or
+    its `name` key for an object) or else from the JSON encoded form field,
+    None if missing. Raise ValueError if the form field is not JSON.
+    """
+    data = request.get_json(silent=True)
+    if data is None:
+        value = request.form.get(name)
+        if not value:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            raise ValueError('Invalid `{}`, must be JSON'.format(name))
+    if isinstance(data, dict):
+        return data.get(name)
+    return data
+
+
+def _sse_event(name, data):
+    return 'event: {}\ndata: {}\n\n'.format(
+        name, jsonify(data, get_response=False))
+
+
+def _tree(root, depth=None, fields=None):
+    # explicit stack, deep trees would hit the recursion limit
     res = []
-    for w in root.children:
-        res.append((w, _tree(w)))
+    stack = [(root, res, 0)]
+    while stack:
+        widget, container, level = stack.pop()
+        if depth is not None and level >= depth:
+            continue
+        for w in widget.children:
+            children = []
+            if fields:
+                container.append((w, children, _tree_fields(w, fields)))
+            else:
+                container.append((w, children))
+            stack.append((w, children, level + 1))
     return res
 
 
+def _iter_tree_nodes(root, depth=None):
+    # (widget, parent, depth) in document order, root excluded
+    stack = [(w, root, 1) for w in reversed(root.children)]
+    while stack:
+        widget, parent, level = stack.pop()
+        yield widget, parent, level
+        if depth is None or level < depth:
+            stack.extend(
+                (w, widget, level + 1) for w in reversed(widget.children))
+
+
+def _tree_fields(widget, fields):
+    return {field: getattr(widget, field, None) for field in fields}
+
+
+def _tree_journal():
+    journal = current_journal()
+    if journal is None:
+        journal = kivythread(journal_install)()
+    return journal
+
+
+def _tree_reset(journal):
+    from kivy.core.window import Window
+
+    @kivythread
+    def _snapshot():
+        # on the Kivy thread, so the tree matches the revision
+        return {
+            'reset': True,
+            'revision': journal.revision,
+            'tree': ('root', _tree(Window)),
+        }
+
+    return _snapshot()
+
+
+@route('/tree/changes')
+def tree_changes():
+    """Structural changes of the tree since the `since` revision, waiting up
+    to `timeout` seconds for one. Without `since`, or if the changes since
+    it are not known anymore, returns the whole tree and its revision with
+    `reset`. Changes are `add` (parent, child, index, widget), `remove`
+    (parent, child) and `reorder` (parent, children). `parent`, `child` and
+    `children` are widget ids, matching the `original_id` of the widgets of
+    the tree, not their `id`: key the nodes of the tree on `original_id`.
+    `widget` is the added widget itself, or null if it is gone.
+    """
+    journal = _tree_journal()
+    since = request.args.get('since', type=int)
+    timeout = request.args.get('timeout', 0, type=float)
+    result = journal.since(since)
+    if result is not None and not result[1] and timeout > 0:
+        journal.wait(since, timeout)
+        result = journal.since(since)
+    if result is None:
+        return api_response(_tree_reset(journal))
+    revision, changes = result
+    return api_response({'revision': revision, 'changes': changes})
+
+
+@route('/tree/stream')
+def tree_stream():
+    """Server-sent events of the tree changes, like /tree/changes: a
+    `reset` event with the whole tree when needed, then `change` events.
+    """
+    since = request.args.get('since', type=int)
+
+    def _stream():
+        journal = _tree_journal()
+        revision = since
+        yield 'retry: 2000\n\n'
+        while True:
+            result = journal.since(revision)
+            if result is None:
+                reset = _tree_reset(journal)
+                revision = reset['revision']
+                yield _sse_event('reset', reset)
+                continue
+            revision, changes = result
+            for change in changes:
+                yield _sse_event('change', change)
+            if not changes and not journal.wait(revision, 10):
+                yield ': keepalive\n\n'
+
+    return Response(_stream(), mimetype='text/event-stream')
+
+
 @route('/inspect/<wid>')
 def inspect(wid):
+    """Properties of a widget, all of them or only the comma separated
+    `fields`.
+    """
     wid = int(wid)
     w = ncis_weakrefs.get(wid)
 
@@ -52,12 +236,109 @@ def inspect(wid):
     if w is None:
         return api_response(None)
 
-    props = {
+    return api_response(_inspect_widget(w, _fields_arg()))
+
+
+@route('/inspect/<wid>/stream')
+def inspect_stream(wid):
+    """Server-sent events of the properties of a widget: a `values` event
+    with all of them (or only the `fields`), then a `change` event with the
+    properties changed since the previous event, and a `gone` event when
+    the widget is deleted.
+    """
+    w = ncis_weakrefs.get(int(wid))
+    w = w() if w is not None else None
+    if w is None:
+        return api_error('Invalid widget')
+    subscription = _InspectSubscription(
+        w, _inspect_names(w, _fields_arg()))
+    del w
+
+    def _stream():
+        kivythread(subscription.bind)()
+        try:
+            yield 'retry: 2000\n\n'
+            w = subscription.widget()
+            if w is None:
+                yield _sse_event('gone', None)
+                return
+            # read after binding, so no change is missed
+            yield _sse_event(
+                'values', _inspect_widget(w, subscription.names))
+            del w
+            while True:
+                changes = subscription.wait(10)
+                if subscription.widget() is None:
+                    yield _sse_event('gone', None)
+                    return
+                if changes:
+                    yield _sse_event('change', {
+                        key: {'value': value}
+                        for key, value in changes.items()})
+                else:
+                    yield ': keepalive\n\n'
+        finally:
+            kivythread(subscription.unbind)()
+
+    return Response(_stream(), mimetype='text/event-stream')
+
+
+def _inspect_names(w, fields=None):
+    # the properties are per instance, kv rules can add some with
+    # create_property, so they can't be cached per class
+    if not fields:
+        return tuple(w.properties())
+    return tuple(name for name in fields
+                 if w.property(name, quiet=True) is not None)
+
+
+def _inspect_widget(w, fields=None):
+    return {
         key: {'value': getattr(w, key)}
-        for key in w.properties()
+        for key in _inspect_names(w, fields)
     }
 
-    return api_response(props)
+
+class _InspectSubscription(object):
+    """Binds the properties of a widget, and keeps their last value until
+    the stream sends them.
+    """
+
+    def __init__(self, widget, names):
+        super(_InspectSubscription, self).__init__()
+        self.widget = weakref.ref(widget)
+        self.names = names
+        self._uids = []
+        self._changes = {}
+        self._cond = threading.Condition()
+
+    def bind(self):
+        widget = self.widget()
+        if widget is None:
+            return
+        for name in self.names:
+            self._uids.append(
+                (name, widget.fbind(name, self._on_change, name)))
+
+    def unbind(self):
+        widget = self.widget()
+        if widget is not None:
+            for name, uid in self._uids:
+                widget.unbind_uid(name, uid)
+        self._uids = []
+
+    def _on_change(self, name, widget, value):
+        with self._cond:
+            self._changes[name] = value
+            self._cond.notify_all()
+
+    def wait(self, timeout):
+        """Return the changes, waiting up to `timeout` seconds for one.
+        """
+        with self._cond:
+            wait_until(self._cond, lambda: self._changes, timeout)
+            changes, self._changes = self._changes, {}
+        return changes
 
 
 #
@@ -69,98 +350,243 @@ telenium_input = False
 NCISMotionEvent = None
 NCISInputProvider = None
 _next_id = count()
+_input_lock = threading.Lock()
 
 def _register_input_provider():
-    global telenium_input, NCISMotionEvent, NCISINputProvider
-    if telenium_input:
-        return
+    global telenium_input, NCISMotionEvent, NCISInputProvider
+    with _input_lock:
+        if telenium_input:
+            return
+
+        from kivy.input.motionevent import MotionEvent
+        from kivy.input.provider import MotionEventProvider
+
+        class NCISMotionEvent(MotionEvent):
+            def depack(self, args):
+                self.is_touch = True
+                self.sx, self.sy = args[:2]
+                super(NCISMotionEvent, self).depack(args)
 
-    from kivy.input.motionevent import MotionEvent
-    from kivy.input.provider import MotionEventProvider
 
-    class NCISMotionEvent(MotionEvent):
-        def depack(self, args):
-            self.is_touch = True
-            self.sx, self.sy = args[:2]
-            super(NCISMotionEvent, self).depack(args)
+        class NCISInputProvider(MotionEventProvider):
+            """Dispatch the events queued from the HTTP threads. Deque appends
+            and pops are atomic, and the scheduled events are only touched
+            from `update`, on the Kivy thread.
+            """
 
+            def __init__(self, *args):
+                super(NCISInputProvider, self).__init__(*args)
+                # (etype, motion event) to dispatch on the next frame
+                self.events = deque()
+                # gestures waiting for their start time
+                self._scripts = deque()
+                # heap of (time, seq, etype, motion event, args, script)
+                self._scheduled = []
+                self._seq = count()
 
-    class NCISInputProvider(MotionEventProvider):
-        events = []
+            def schedule(self, entries):
+                """Schedule (delay, etype, motion event, args) entries, the
+                delays being relative to the frame time of the next frame.
+                Return an Event set once all of them are dispatched.
+                """
+                done = threading.Event()
+                self._scripts.append((entries, done))
+                return done
 
-        def update(self, dispatch_fn):
-            while self.events:
-                event = self.events.pop(0)
-                dispatch_fn(*event)
+            def update(self, dispatch_fn):
+                events = self.events
+                while events:
+                    dispatch_fn(*events.popleft())
+                if not self._scripts and not self._scheduled:
+                    return
 
-    telenium_input = NCISInputProvider('ncis', None)
-    from kivy.base import EventLoop
-    EventLoop.add_input_provider(telenium_input)
+                from kivy.clock import Clock
+                now = Clock.get_time()
+                scheduled = self._scheduled
+                while self._scripts:
+                    entries, done = self._scripts.popleft()
+                    script = [len(entries), done]
+                    for delay, etype, me, args in entries:
+                        heappush(scheduled, (
+                            now + delay, next(self._seq), etype, me, args,
+                            script))
+                while scheduled and scheduled[0][0] <= now:
+                    _, _, etype, me, args, script = heappop(scheduled)
+                    if args is not None:
+                        me.move(args)
+                    dispatch_fn(etype, me)
+                    script[0] -= 1
+                    if not script[0]:
+                        script[1].set()
+
+        telenium_input = NCISInputProvider('ncis', None)
+        from kivy.base import EventLoop
+        EventLoop.add_input_provider(telenium_input)
 
 
 def _path_to(widget):
+    return widget_paths([widget])[0]
+
+def _click_widget(w):
+    global _next_id
+    _register_input_provider()
     from kivy.core.window import Window
-    root = Window
-    if widget.parent is root or widget.parent == widget or not widget.parent:
-        return "/{}".format(widget.__class__.__name__)
-    return "{}/{}[{}]".format(
-        _path_to(widget.parent), widget.__class__.__name__,
-        widget.parent.children.index(widget))
-
-def _select_all(selector, root=None):
-    app = kivyapp()
-    if not app:
-        return []
-    if root is None:
-        root = app.root.parent
-    parser = XpathParser()
-    matches = parser.parse(selector)
-    matches = matches.execute(root)
-    return matches or []
-
-
-def _select_first(selector, root=None):
-    matches = _select_all(selector, root=root)
-    if matches:
-        return matches[0]
-
-
-def _pick_widget(widget, x, y):
-    ret = None
-    # try to filter widgets that are not visible (invalid inspect target)
-    if (hasattr(widget, 'visible') and not widget.visible):
-        return ret
-    if widget.collide_point(x, y):
-        ret = widget
-        x2, y2 = widget.to_local(x, y)
-        # reverse the loop - look at children on top first
-        for child in reversed(widget.children):
-            ret = _pick_widget(child, x2, y2) or ret
-    return ret
-
-
-def _collide_at(widget, x, y):
-    if widget.collide_point(x, y):
-        x2, y2 = widget.to_local(x, y)
-        have_results = False
-        for child in reversed(widget.children):
-            for ret in _collide_at(child, x2, y2):
-                yield ret
-                have_results = True
-        if not have_results:
-            yield widget
+    cx, cy = w.to_window(w.center_x, w.center_y)
+    sx = cx / float(Window.width)
+    sy = cy / float(Window.height)
+    me = NCISMotionEvent(
+        "ncis_me", id=next(_next_id), args=[sx, sy])
+    telenium_input.events.extend((("begin", me), ("end", me)))
 
 
-@kivythread
-def _send_keycode(key, scancode, sym, modifiers):
+def _gesture_entries(strokes):
+    """Return the (delay, etype, motion event, args) entries of the strokes
+    of a gesture, see /gesture.
+    """
+    from kivy.core.window import Window
+    width = float(Window.width)
+    height = float(Window.height)
+    entries = []
+    for stroke in strokes:
+        points = stroke.get('points')
+        if not points:
+            raise ValueError('stroke without `points`')
+        ox = oy = 0
+        if stroke.get('selector'):
+            w = select_first(stroke['selector'])
+            if w is None:
+                raise ValueError(
+                    'no widget matching {!r}'.format(stroke['selector']))
+            ox, oy = w.to_window(w.center_x, w.center_y)
+        start = float(stroke.get('start', 0))
+        duration = float(stroke.get('duration', 0))
+        step = duration / max(len(points) - 1, 1)
+
+        me = None
+        for i, point in enumerate(points):
+            delay = start + (float(point[2]) if len(point) > 2 else i * step)
+            args = [(ox + point[0]) / width, (oy + point[1]) / height]
+            if me is None:
+                me = NCISMotionEvent("ncis_me", id=next(_next_id), args=args)
+                entries.append((delay, 'begin', me, None))
+            else:
+                entries.append((delay, 'update', me, args))
+        entries.append((delay, 'end', me, None))
+    return entries
+
+
+def _dispatch_key(key, scancode, sym, modifiers):
     from kivy.core.window import Window
-    print("Telenium: send key key={!r} scancode={} sym={!r} modifiers={}".format(
-        key, scancode, sym, modifiers
-    ))
     if not Window.dispatch("on_key_down", key, scancode, sym, modifiers):
         Window.dispatch("on_keyboard", key, scancode, sym, modifiers)
     Window.dispatch("on_key_up", key, scancode)
-    return True
+
+
+@kivythread
+def _send_keycode(key, scancode, sym, modifiers):
+    from kivy.logger import Logger
+    Logger.debug(
+        "NCIS: send key key={!r} scancode={} sym={!r} modifiers={}".format(
+            key, scancode, sym, modifiers))
+    _dispatch_key(key, scancode, sym, modifiers)
+
+
+# characters typed with a key, without text input
+_text_keys = {'\n': 13, '\r': 13, '\t': 9, '\b': 8}
+
+
+def _dispatch_text(char):
+    # like a keyboard: key down, text input, key up
+    from kivy.core.window import Window
+    if char in _text_keys:
+        _dispatch_key(_text_keys[char], 0, char, [])
+        return
+    key = ord(char.lower()) if len(char.lower()) == 1 else 0
+    modifiers = ['shift'] if char.isupper() else []
+    if not Window.dispatch("on_key_down", key, 0, char, modifiers):
+        Window.dispatch("on_keyboard", key, 0, char, modifiers)
+    Window.dispatch("on_textinput", char)
+    Window.dispatch("on_key_up", key, 0)
+
+
+class _KeySequence(object):
+    """Dispatch (delay, function, args) steps on the Kivy thread, each one
+    `delay` seconds after the previous one. Steps without delay are
+    dispatched in the same frame.
+    """
+
+    def __init__(self, steps):
+        super(_KeySequence, self).__init__()
+        self.steps = steps
+        self.position = 0
+        self.error = None
+        self.done = threading.Event()
+
+    def start(self):
+        self._schedule()
+
+    def _schedule(self):
+        from kivy.clock import Clock
+        if self.position >= len(self.steps):
+            self.done.set()
+            return
+        delay = self.steps[self.position][0]
+        if delay > 0:
+            Clock.schedule_once(self._step, delay)
+        else:
+            self._step()
+
+    def _step(self, *largs):
+        steps = self.steps
+        while True:
+            _, f, args = steps[self.position]
+            self.position += 1
+            try:
+                f(*args)
+            except Exception as e:
+                # stop there and report it, raising would stop the app
+                traceback.print_exc()
+                self.error = e
+                self.done.set()
+                return
+            if self.position >= len(steps) or steps[self.position][0] > 0:
+                break
+        self._schedule()
+
+
+@route('/xpath/stats')
+def rpc_xpath_stats():
+    return api_response(xpath_cache.stats())
+
+
+@route('/dispatcher/stats')
+def rpc_dispatcher_stats():
+    """Calls run on the Kivy thread, and the histogram of the time they
+    waited in the queue.
+    """
+    return api_response(dispatcher.stats())
+
+
+@route('/index', methods=['GET', 'POST'])
+def rpc_index():
+    if request.method == 'POST':
+        enabled = request.form.get('enabled', '1') not in ('0', 'false')
+        debug = bool(request.form.get('debug'))
+
+        @kivythread
+        def _toggle():
+            if enabled:
+                index_install(debug=debug)
+            else:
+                index_uninstall()
+
+        _toggle()
+
+    widget_index = current_index()
+    return api_response({
+        'enabled': widget_index is not None,
+        'stats': widget_index.stats() if widget_index else None
+    })
 
 
 @route('/exists', methods=['POST'])
@@ -168,10 +594,143 @@ def rpc_exists():
     selector = request.form.get('selector')
     if not selector:
         return api_error('Missing `selector`')
-    result = _select_first(selector)
+    result = select_first(selector)
     return api_response({'result': result is not None})
 
 
+@route('/wait', methods=['POST'])
+def rpc_wait():
+    """Wait up to `timeout` seconds (10 by default) for a widget matching
+    `selector`, and, with `attr`, for one of them to satisfy the predicate
+    `attr`, `op` (=, !=, ~= or !~=, = by default) and the JSON `value`, like
+    [@attr=value] in selectors. Without `value`, the widget only needs to
+    have `attr`.
+
+    The condition is checked again on the next frame after a change of the
+    tree, or of a property it depends on. Returns `result` and the `path` of
+    the widget found.
+    """
+    selector = request.form.get('selector')
+    if not selector:
+        return api_error('Missing `selector`')
+    timeout = request.form.get('timeout', 10., type=float)
+    predicate = None
+    attr = request.form.get('attr')
+    if attr:
+        value = request.form.get('value')
+        op = request.form.get('op', '=')
+        if value is None:
+            predicate = AttrExistSelector(attr=attr)
+        elif op not in ('=', '!=', '~=', '!~='):
+            return api_error('Invalid `op`')
+        else:
+            try:
+                predicate = AttrOpSelector(attr=attr, op=op, value=value)
+            except ValueError:
+                return api_error('Invalid `value`, must be JSON')
+
+    waiter = _SelectorWaiter(compile_xpath(selector), predicate)
+    kivythread(waiter.start)()
+    if not waiter.done.wait(timeout):
+        kivythread(waiter.stop)()
+    return api_response({
+        'result': waiter.path is not None,
+        'path': waiter.path
+    })
+
+
+class _SelectorWaiter(object):
+    """Check a selector and a predicate on the Kivy thread, again on the
+    next frame after each change of the tree (from the index) or of the
+    properties examined by the last check, until it holds.
+    """
+
+    def __init__(self, selector, predicate=None):
+        super(_SelectorWaiter, self).__init__()
+        self.selector = selector
+        self.predicate = predicate
+        self.path = None
+        self.done = threading.Event()
+        self._index = None
+        # index of this waiter, when the global one is not installed
+        self._own_index = None
+        self._trigger = None
+        # (id, attr) -> (widget, attr, binding uid)
+        self._bound = {}
+
+    def start(self):
+        from kivy.clock import Clock
+        from kivy.core.window import Window
+        self._index = current_index()
+        if self._index is None:
+            # for the tree changes, without making every selector use it
+            self._index = self._own_index = WidgetIndex(Window)
+        self._index.listeners.append(self._on_change)
+        self._trigger = Clock.create_trigger(self.check, 0)
+        try:
+            self.check()
+        except Exception:
+            self.stop()
+            raise
+
+    def stop(self):
+        self.done.set()
+        if self._trigger is not None:
+            self._trigger.cancel()
+        if self._index is not None and \
+                self._on_change in self._index.listeners:
+            self._index.listeners.remove(self._on_change)
+        if self._own_index is not None:
+            self._own_index.uninstall()
+            self._own_index = None
+        self._rebind({})
+
+    def _on_change(self, *largs):
+        self._trigger()
+
+    def check(self, *largs):
+        if self.done.is_set():
+            return
+        app = kivyapp()
+        if not app:
+            return
+        root = app.root.parent
+        predicate = self.predicate
+        seen = {}
+        found = None
+        selector = observe_attributes(self.selector, seen)
+        for widget in selector.iterate(root, index=self._index):
+            if predicate is None:
+                found = widget
+                break
+            seen[(id(widget), predicate.attr)] = (widget, predicate.attr)
+            if any(predicate.filter(root, [widget])):
+                found = widget
+                break
+        if found is not None:
+            self.path = widget_paths([found], self._index)[0]
+            self.stop()
+        else:
+            self._rebind(seen)
+
+    def _rebind(self, seen):
+        bound = self._bound
+        for key in list(bound):
+            if key not in seen:
+                widget, attr, uid = bound.pop(key)
+                if uid:
+                    widget.unbind_uid(attr, uid)
+        for key, (widget, attr) in seen.items():
+            if key in bound:
+                continue
+            try:
+                uid = widget.fbind(attr, self._on_change)
+            except (AttributeError, KeyError):
+                # not a property, changes can't be observed
+                uid = None
+            bound[key] = (widget, attr, uid)
+
+
 @route('/select', methods=['POST'])
 def rpc_select():
     selector = request.form.get('selector')
@@ -179,20 +738,16 @@ def rpc_select():
         return api_error('Missing `selector`')
     with_bounds = bool(request.form.get('with_bounds'))
     if not with_bounds:
-        results = list(map(_path_to, _select_all(selector)))
+        results = widget_paths(select_all(selector))
         return api_response({
             'selector': selector,
             'with_bounds': with_bounds,
             'results': results
         })
 
-    results = []
-    for widget in _select_all(selector):
-        left, bottom = widget.to_window(widget.x, widget.y)
-        right, top = widget.to_window(widget.x + widget.width, widget.y + widget.height)
-        bounds = (left, bottom, right, top)
-        path = _path_to(widget)
-        results.append((path, bounds))
+    widgets = select_all(selector)
+    results = list(zip(
+        widget_paths(widgets), map(widget_bounds, widgets)))
 
     return api_response({
         'selector': selector,
@@ -213,38 +768,210 @@ def rpc_setattr():
     if not value:
         return api_error('Missing `value`')
 
-    updated = 0
-    for widget in _select_all(selector):
-        setattr(widget, key, value)
-        updated += 1
+    @kivythread
+    def _setattr():
+        return _set_widgets_attr(select_all(selector), key, value)
 
     return api_response({
-        'updated': updated
+        'updated': _setattr()
     })
 
 
+@route('/setattr/bulk', methods=['POST'])
+def rpc_setattr_bulk():
+    """Set many attributes in one Kivy frame, so layout and redraw happen
+    once. The body is a JSON list of `[selector, key, value]` or
+    `{"selector", "key", "value"}` entries, the values being typed JSON. All
+    the selectors are resolved before any value is set. Returns one result
+    per entry, `{"updated": count}` or `{"error": message}`.
+    """
+    try:
+        entries = _json_arg('entries')
+    except ValueError as e:
+        return api_error(str(e))
+    if not isinstance(entries, list):
+        return api_error('Missing `entries`')
+    try:
+        entries = [_setattr_entry(entry) for entry in entries]
+    except (ValueError, TypeError, KeyError):
+        return api_error('Invalid entry, expected selector, key and value')
+
+    @kivythread
+    def _apply():
+        app = kivyapp()
+        index = current_index()
+        if index is None and app:
+            index = TreeSnapshot(app.root.parent)
+        targets = []
+        for selector, key, value in entries:
+            try:
+                targets.append(select_all(selector, index=index))
+            except Exception as e:
+                targets.append(e)
+        results = []
+        for (selector, key, value), widgets in zip(entries, targets):
+            if isinstance(widgets, Exception):
+                results.append({'error': str(widgets)})
+                continue
+            try:
+                results.append(
+                    {'updated': _set_widgets_attr(widgets, key, value)})
+            except Exception as e:
+                results.append({'error': str(e)})
+        return results
+
+    return api_response({'results': _apply()})
+
+
+def _setattr_entry(entry):
+    if isinstance(entry, dict):
+        entry = (entry['selector'], entry['key'], entry['value'])
+    selector, key, value = entry
+    if not selector or not key:
+        raise ValueError(entry)
+    return selector, key, value
+
+
+def _set_widgets_attr(widgets, key, value):
+    updated = 0
+    for widget in widgets:
+        setattr(widget, key, value)
+        updated += 1
+    return updated
+
+
 @route('/click', methods=['POST'])
 def rpc_click():
-    global _next_id
     selector = request.form.get('selector')
     if not selector:
         return api_error('Missing `selector`')
-    w = _select_first(selector)
+    w = select_first(selector)
     if not w:
         return api_error('No widget matching `selector`')
 
-    _register_input_provider()
-    from kivy.core.window import Window
-    cx, cy = w.to_window(w.center_x, w.center_y)
-    sx = cx / float(Window.width)
-    sy = cy / float(Window.height)
-    me = NCISMotionEvent(
-        "ncis_me", id=next(_next_id), args=[sx, sy])
-    telenium_input.events.append(("begin", me))
-    telenium_input.events.append(("end", me))
+    _click_widget(w)
     return api_response()
 
 
+@route('/gesture', methods=['POST'])
+def rpc_gesture():
+    """Replay a gesture made of touch strokes, all scheduled against the
+    Kivy clock. The body is a JSON list of strokes (or `{"strokes": [...],
+    "wait": true}`), each one `{"points": [[x, y, t], ...]}`: the touch
+    goes down at the first point, moves through the others and goes up at
+    the last one. `t` is the time in seconds since the `start` of the stroke
+    (0 by default); without it, the points are spread evenly over the
+    `duration` of the stroke. Points are in window coordinates, or relative
+    to the center of the widget matching the `selector` of the stroke.
+    Strokes overlapping in time are multi-touch, and a long press is a
+    stroke like `[[0, 0, 0], [0, 0, 1.5]]`. With `wait`, returns once the
+    whole gesture was dispatched.
+    """
+    try:
+        strokes = _json_arg('strokes')
+    except ValueError as e:
+        return api_error(str(e))
+    if not strokes or not isinstance(strokes, list):
+        return api_error('Missing `strokes`')
+
+    _register_input_provider()
+    try:
+        entries = _gesture_entries(strokes)
+    except (ValueError, TypeError, IndexError, AttributeError) as e:
+        return api_error('Invalid stroke: {}'.format(e))
+    done = telenium_input.schedule(entries)
+    duration = max(entry[0] for entry in entries)
+    completed = None
+    if script.get('wait'):
+        completed = done.wait(duration + 10)
+    return api_response({
+        'events': len(entries),
+        'duration': duration,
+        'completed': completed
+    })
+
+
+def _batch_select(op, index):
+    widgets = select_all(op['selector'], index=index)
+    if op.get('with_bounds'):
+        return list(zip(
+            widget_paths(widgets, index), map(widget_bounds, widgets)))
+    return widget_paths(widgets, index)
+
+
+def _batch_exists(op, index):
+    return select_first(op['selector'], index=index) is not None
+
+
+def _batch_setattr(op, index):
+    widgets = select_all(op['selector'], index=index)
+    return {'updated': _set_widgets_attr(widgets, op['key'], op['value'])}
+
+
+def _batch_click(op, index):
+    w = select_first(op['selector'], index=index)
+    if not w:
+        raise Exception('No widget matching `selector`')
+    _click_widget(w)
+
+
+def _batch_inspect(op, index):
+    if 'wid' in op:
+        w = ncis_weakrefs.get(int(op['wid']))
+        w = w() if w is not None else None
+    else:
+        w = select_first(op['selector'], index=index)
+    if w is None:
+        return None
+    return _inspect_widget(w, op.get('fields'))
+
+
+_batch_ops = {
+    'select': _batch_select,
+    'exists': _batch_exists,
+    'setattr': _batch_setattr,
+    'click': _batch_click,
+    'inspect': _batch_inspect,
+}
+
+
+@route('/batch', methods=['POST'])
+def rpc_batch():
+    """Run a list of operations in one Kivy frame, against the same tree
+    snapshot. The body is a JSON list of operations such as
+    `{"op": "select", "selector": "//Button", "with_bounds": true}`, with
+    `op` one of select, exists, setattr (`key`, JSON `value`), click and
+    inspect (`wid` or `selector`). Returns one result per operation.
+    """
+    try:
+        ops = _json_arg('operations')
+    except ValueError as e:
+        return api_error(str(e))
+    if not isinstance(ops, list):
+        return api_error('Missing `operations`')
+    for op in ops:
+        if not isinstance(op, dict) or op.get('op') not in _batch_ops:
+            return api_error('Invalid operation {!r}'.format(op))
+
+    @kivythread
+    def _run_batch():
+        results = []
+        app = kivyapp()
+        # the live index is kept up to date, otherwise walk the tree once
+        index = current_index()
+        if index is None and app:
+            index = TreeSnapshot(app.root.parent)
+        for op in ops:
+            try:
+                result = _batch_ops[op['op']](op, index)
+                results.append({'result': result})
+            except Exception as e:
+                results.append({'error': str(e)})
+        return results
+
+    return api_response({'results': _run_batch()})
+
+
 @route('/pick')
 def rpc_pick(all=False):
     from kivy.core.window import Window
@@ -252,13 +979,7 @@ def rpc_pick(all=False):
     ev = threading.Event()
 
     def on_touch_down(touch):
-        root = kivyapp().root
-        for widget in Window.children:
-            if all:
-                widgets.extend(list(_collide_at(root, touch.x, touch.y)))
-            else:
-                widget = _pick_widget(root, touch.x, touch.y)
-                widgets.append(widget)
+        widgets.extend(pick_at(touch.x, touch.y, all))
         ev.set()
         return True
 
@@ -269,18 +990,68 @@ def rpc_pick(all=False):
     ret = []
     if widgets:
         if all:
-            ret = list(map(_path_to, widgets))
+            ret = widget_paths(widgets)
         else:
             ret = _path_to(widgets[0])
     return api_response({'results': ret})
 
 
+@route('/pick_at')
+def rpc_pick_at():
+    """Pick without waiting for a touch: the widget at `x`, `y` in window
+    coordinates, like /pick, or with `all` the deepest widgets colliding
+    there. With `w` and `h`, the visible widgets overlapping the rectangle
+    instead. Answered from the spatial index when NumPy is available.
+    """
+    args = request.args
+    x = args.get('x', type=float)
+    y = args.get('y', type=float)
+    if x is None or y is None:
+        return api_error('Missing `x` or `y`')
+    width = args.get('w', type=float)
+    height = args.get('h', type=float)
+    all = bool(args.get('all'))
+
+    try:
+        from ncis_kivy.spatial import spatial_snapshot
+    except ImportError:
+        spatial_snapshot = None
+    if spatial_snapshot is None:
+        if width is not None and height is not None:
+            return api_error('NumPy is required for rectangle queries')
+        widgets = kivythread(pick_at)(x, y, all)
+    else:
+        # the snapshot is immutable, query it from this thread
+        snapshot = kivythread(spatial_snapshot)()
+        if width is not None and height is not None:
+            widgets = snapshot.overlap(x, y, x + width, y + height)
+        elif all:
+            widgets = snapshot.collide(x, y)
+        else:
+            widget = snapshot.pick(x, y)
+            widgets = [widget] if widget is not None else []
+
+    return api_response({
+        'results': widget_paths(widgets),
+        'widgets': widgets
+    })
+
+
 @route('/sendkeycodes', methods=['POST'])
 def rpc_send_keycode():
     keycodes = request.form.get('keycodes')
     if not keycodes:
         return api_error('Missing `keycodes`')
+    try:
+        chord = _parse_keycodes(keycodes)
+    except Exception as e:
+        traceback.print_exc()
+        return api_error(e)
+    _send_keycode(*chord)
+    return api_response()
 
+
+def _parse_keycodes(keycodes):
     # very hard to get it right, not fully tested and fail proof.
     # just the basics.
     from kivy.core.window import Keyboard
@@ -290,7 +1061,7 @@ def rpc_send_keycode():
     sym = ""
     modifiers = []
     for el in keys:
-        if re.match("^[A-Z]", el):
+        if re.match("^[A-Za-z]", el):
             lower_el = el.lower()
             # modifier detected ? add it
             if lower_el in ("ctrl", "meta", "alt", "shift"):
@@ -301,11 +1072,61 @@ def rpc_send_keycode():
             key = Keyboard.keycodes.get(lower_el, 0)
         else:
             # may fail, so nothing would be done.
-            try:
-                key = int(el)
-                sym = unichr(key)
-            except Exception as e:
-                traceback.print_exc()
-                return api_error(e)
-    _send_keycode(key, scancode, sym, modifiers)
-    return api_response()
+            key = int(el)
+            sym = unichr(key)
+    return key, scancode, sym, modifiers
+
+
+@route('/sendkeys', methods=['POST'])
+def rpc_send_keys():
+    """Type a text or a sequence of keys, all dispatched from the Kivy
+    thread. The body is JSON, `{"text": "hello", "delay": 0.05}` or
+    `{"sequence": ["Ctrl+a", {"text": "hi"}, {"keys": "13", "delay": 0.5}]}`,
+    the entries of the sequence being chords like /sendkeycodes, or texts.
+    `delay` is the time in seconds before each key (0 by default, all the
+    keys in the same frame), and can be set per entry. Returns once the
+    whole sequence was dispatched, unless `wait` is false.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {'text': request.form.get('text'),
+                'delay': request.form.get('delay', 0),
+                'wait': request.form.get('wait', '1') not in ('0', 'false')}
+        try:
+            data['sequence'] = _json_arg('sequence')
+        except ValueError as e:
+            return api_error(str(e))
+
+    steps = []
+    try:
+        delay = float(data.get('delay') or 0)
+        sequence = list(data.get('sequence') or [])
+        if data.get('text'):
+            sequence.insert(0, {'text': data['text']})
+        for entry in sequence:
+            if not isinstance(entry, dict):
+                entry = {'keys': entry}
+            entry_delay = float(entry.get('delay', delay))
+            if entry.get('text'):
+                steps.extend((entry_delay, _dispatch_text, (char, ))
+                             for char in entry['text'])
+            elif entry.get('keys'):
+                steps.append((entry_delay, _dispatch_key,
+                              _parse_keycodes(str(entry['keys']))))
+            else:
+                raise ValueError('entry without `text` or `keys`')
+    except Exception as e:
+        return api_error('Invalid sequence: {}'.format(e))
+    if not steps:
+        return api_error('Missing `text` or `sequence`')
+
+    keys = _KeySequence(steps)
+    kivythread(keys.start)()
+    completed = None
+    if data.get('wait', True):
+        completed = keys.done.wait(sum(step[0] for step in steps) + 10)
+    return api_response({
+        'keys': len(steps),
+        'completed': completed,
+        'error': str(keys.error) if keys.error is not None else None
+    })
@@ -8,17 +8,81 @@ HTTP stream. Or just make a screenshot.
 
 
 from flask import Response, abort
-from ncis import route, api_response, request
-from ncis_kivy.utils import kivyapp
-from time import sleep
+from ncis import route, api_response, api_error, request
+from ncis_kivy.utils import (
+    kivyapp, select_first, widget_bounds, wait_until)
+from ncis_kivy.readback import readback_create
+from ncis_kivy.xpath import compile_xpath
+from ncis_kivy.metrics import span
+from collections import namedtuple, deque
+from itertools import count
+from operator import itemgetter
+from threading import Condition, Event, Lock, Thread
+from math import ceil
+from time import time
+import traceback
+import zlib
 import io
 
 
+#: a captured frame, `seq` increases with every new frame
+Frame = namedtuple(
+    "Frame", "seq timestamp width height pixelfmt pixels digest flipped")
+
+#: a frame encoded in an image format, shared by all the clients
+EncodedFrame = namedtuple("EncodedFrame", "seq fmt data")
+
+
 screenstream_ctx = {
     "installed": False,
     "data": None,
-    "window": None
+    "window": None,
+    # number of /screenshot and /screenstream clients, the capture is
+    # only bound to the window while there is one
+    "subscribers": 0,
+    # pending region screenshots, read at the next flip
+    "regions": [],
+    "bound": False,
+    # maximum number of captures per second, 0 to capture every frame
+    "max_fps": 0,
+    # capture scale, 1 for the full window resolution
+    "scale": 1.,
+    # hash the captured pixels and drop the frames identical to the last one
+    "hash": False,
+    # "sync" glReadPixels, or "pbo" for the asynchronous readback
+    "readback_mode": "sync",
+    # (mode, readback) in use, created from the GL thread
+    "readback": None,
+    # set when the capture is bound again, to drop the pending frames
+    "restarted": False,
+    # capture time of the frame pending in the asynchronous readback
+    "pending_timestamp": None,
+    # set while the window is redrawn to flush the asynchronous readback
+    "flushing": False,
+    "flush_trigger": None,
+    # redraw once the max_fps interval is over, after a throttled flip
+    "throttle_trigger": None,
+    "throttle_pending": False,
+    "last_capture": 0,
+    # number of one-shot screenshots waiting for the next capture, which
+    # is then not held back by max_fps
+    "waiting": 0,
+    # number of captures, including the ones identical to the last frame
+    # and so not published
+    "captures": 0,
+    # shared memory ring the frames are published to, see ncis_kivy.shm
+    "shm": None,
 }
+_frame_seq = count(1)
+screenstream_lock = Lock()
+# notified by the capture every time a new frame is published
+screenstream_frame_cond = Condition()
+
+#: seconds to wait for a frame before a screenshot fails
+SCREENSHOT_TIMEOUT = 10.
+#: seconds without new frame before the last one is sent again to a
+#: stream client, which is also how a disconnected client is detected
+SCREENSTREAM_KEEPALIVE = 5.
 
 
 def screenstream_get_loader(fmt):
@@ -30,41 +94,472 @@ def screenstream_get_loader(fmt):
     return loaders[0]
 
 
-def screenstream_install(fmt):
-    if fmt not in ('png', 'jpg'):
+def screenstream_install(fmt=None):
+    if fmt is not None and fmt not in ('png', 'jpg'):
         return
 
     if screenstream_ctx["installed"]:
-        return
-
-    from kivy.app import App
+        return True
 
     window = kivyapp().root_window
     if not window:
         return
 
-    def _window_flip_and_save(*largs):
-        from kivy.graphics.opengl import glReadPixels, GL_RGB, GL_UNSIGNED_BYTE
-        width, height = window.size
-        pixels = glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
-        screenstream_ctx["data"] = (width, height, "rgb", pixels)
-
-    window.bind(on_flip=_window_flip_and_save)
     screenstream_ctx["installed"] = True
     screenstream_ctx["window"] = window
 
     return True
 
 
-def screenstream_get_image(fmt, loader):
-    width, height, pixelfmt, pixels = screenstream_ctx["data"]
+def _update_binding():
+    # must be called with screenstream_lock held
+    bound = bool(screenstream_ctx["subscribers"] or screenstream_ctx["regions"])
+    if bound == screenstream_ctx["bound"]:
+        return
+    window = screenstream_ctx["window"]
+    if bound:
+        window.bind(on_flip=_window_flip_and_save)
+    else:
+        window.unbind(on_flip=_window_flip_and_save)
+    screenstream_ctx["bound"] = bound
+
+
+def screenstream_subscribe():
+    with screenstream_lock:
+        screenstream_ctx["subscribers"] += 1
+        if screenstream_ctx["subscribers"] == 1:
+            screenstream_ctx["restarted"] = True
+        _update_binding()
+
+
+def screenstream_unsubscribe():
+    with screenstream_lock:
+        screenstream_ctx["subscribers"] -= 1
+        _update_binding()
+
+
+def screenstream_capture_region(rect=None, selector=None, scale=1.,
+                                timeout=None):
+    """Read only a region of the window at the next flip, and return it as
+    a Frame. The region is either a `rect` (x, y, width, height) in window
+    coordinates, or the bounds of the first widget matching `selector`,
+    resolved at capture time. Return None on timeout.
+    """
+    region = {
+        "rect": rect,
+        "selector": selector,
+        "scale": scale,
+        "event": Event(),
+        "frame": None,
+        "error": None,
+    }
+    with screenstream_lock:
+        screenstream_ctx["regions"].append(region)
+        _update_binding()
+    screenstream_ctx["window"].canvas.ask_update()
+
+    region["event"].wait(timeout)
+    with screenstream_lock:
+        if region in screenstream_ctx["regions"]:
+            screenstream_ctx["regions"].remove(region)
+            _update_binding()
+    if region["error"] is not None:
+        raise region["error"]
+    return region["frame"]
+
+
+def _capture_regions(window):
+    from kivy.graphics.opengl import glReadPixels, GL_RGB, GL_UNSIGNED_BYTE
+    with screenstream_lock:
+        regions = screenstream_ctx["regions"]
+        screenstream_ctx["regions"] = []
+        _update_binding()
+
+    win_width, win_height = window.size
+    for region in regions:
+        try:
+            rect = region["rect"]
+            if rect is None:
+                widget = select_first(region["selector"])
+                if widget is None:
+                    raise ValueError("No widget matching `selector`")
+                left, bottom, right, top = widget_bounds(widget)
+                rect = (left, bottom, right - left, top - bottom)
+            x, y, width, height = rect
+            left = max(0, int(x))
+            bottom = max(0, int(y))
+            right = min(win_width, int(ceil(x + width)))
+            top = min(win_height, int(ceil(y + height)))
+            if right <= left or top <= bottom:
+                raise ValueError("Empty region")
+            width = right - left
+            height = top - bottom
+            pixels = glReadPixels(
+                left, bottom, width, height, GL_RGB, GL_UNSIGNED_BYTE)
+            width, height, pixels = _scale(
+                width, height, pixels, region["scale"])
+            region["frame"] = Frame(
+                None, time(), width, height, "rgb", pixels, None, True)
+        except Exception as e:
+            region["error"] = e
+        region["event"].set()
+
+
+def screenstream_wait_frame(after_seq=None, timeout=None, after_capture=None):
+    """Return the last captured frame if newer than `after_seq`, waiting up
+    to `timeout` seconds for it. With `after_capture`, a capture count,
+    return the last frame once a capture happened after it, even if it was
+    identical and the frame did not change. Return None on timeout.
+    """
+    def _ready():
+        frame = screenstream_ctx["data"]
+        if frame is None:
+            return
+        if after_capture is not None:
+            if screenstream_ctx["captures"] > after_capture:
+                return frame
+        elif after_seq is None or frame.seq > after_seq:
+            return frame
+
+    with screenstream_frame_cond:
+        return wait_until(screenstream_frame_cond, _ready, timeout)
+
+
+def screenstream_next_frame(timeout=None):
+    """Ask for a redraw and return the frame current after the next
+    capture, a new one or the last one if the capture was identical.
+    Waits up to `timeout` seconds, return None on timeout. The caller must
+    be subscribed.
+    """
+    with screenstream_lock:
+        screenstream_ctx["waiting"] += 1
+    try:
+        with screenstream_frame_cond:
+            captures = screenstream_ctx["captures"]
+        screenstream_ctx["window"].canvas.ask_update()
+        return screenstream_wait_frame(
+            timeout=timeout, after_capture=captures)
+    finally:
+        with screenstream_lock:
+            screenstream_ctx["waiting"] -= 1
+
+
+def screenstream_configure(max_fps=None, scale=None, content_hash=None,
+                           readback=None):
+    if readback is not None:
+        if readback not in ("sync", "pbo"):
+            raise ValueError("Invalid readback {!r}".format(readback))
+        screenstream_ctx["readback_mode"] = readback
+    if content_hash is not None:
+        screenstream_ctx["hash"] = content_hash
+    if max_fps is not None:
+        screenstream_ctx["max_fps"] = max(0, float(max_fps))
+    if scale is not None:
+        screenstream_ctx["scale"] = min(1., max(0.01, float(scale)))
+
+
+def _window_flip_and_save(window, *largs):
+    if screenstream_ctx["regions"]:
+        _capture_regions(window)
+    if not screenstream_ctx["subscribers"]:
+        return
+
+    max_fps = screenstream_ctx["max_fps"]
+    now = time()
+    # nothing would ask for another redraw, so the first capture after a
+    # subscribe, or for a screenshot, is not throttled
+    throttled = not (
+        screenstream_ctx["flushing"] or screenstream_ctx["restarted"] or
+        screenstream_ctx["waiting"])
+    elapsed = now - screenstream_ctx["last_capture"]
+    if max_fps and throttled and elapsed < 1. / max_fps:
+        # the window may not redraw again, capture its state at the end of
+        # the interval
+        _redraw_later(1. / max_fps - elapsed)
+        return
+    screenstream_ctx["last_capture"] = now
+
+    readback = _get_readback()
+    if screenstream_ctx["restarted"]:
+        screenstream_ctx["restarted"] = False
+        readback.reset()
+
+    width, height = window.size
+    try:
+        with span("readback"):
+            pixels = readback.read(width, height)
+    except Exception:
+        if not readback.delayed:
+            raise
+        # asynchronous readback failing, fall back on the synchronous one
+        traceback.print_exc()
+        screenstream_ctx["readback_mode"] = "sync"
+        return
+
+    if readback.delayed:
+        # the readback returns the previous frame, make sure the current
+        # one comes out if the window stops redrawing
+        now, screenstream_ctx["pending_timestamp"] = \
+            screenstream_ctx["pending_timestamp"], now
+        if screenstream_ctx["flushing"]:
+            screenstream_ctx["flushing"] = False
+        else:
+            _flush_readback()
+    if pixels is None:
+        return
+
+    width, height, pixels = _scale(
+        width, height, pixels, screenstream_ctx["scale"])
+
+    digest = None
+    if screenstream_ctx["hash"]:
+        digest = zlib.crc32(pixels) & 0xffffffff
+        last = screenstream_ctx["data"]
+        if last and last.digest == digest and \
+                (last.width, last.height) == (width, height):
+            # not published, but the screenshots waiting for a capture get
+            # the last frame
+            with screenstream_frame_cond:
+                screenstream_ctx["captures"] += 1
+                screenstream_frame_cond.notify_all()
+            return
+
+    frame = Frame(next(_frame_seq), now, width, height, "rgb", pixels, digest,
+                  readback.flipped)
+    with screenstream_frame_cond:
+        screenstream_ctx["data"] = frame
+        screenstream_ctx["captures"] += 1
+        screenstream_frame_cond.notify_all()
+
+
+def _get_readback():
+    mode = screenstream_ctx["readback_mode"]
+    current = screenstream_ctx["readback"]
+    if current is not None and current[0] == mode:
+        return current[1]
+    if current is not None and hasattr(current[1], "release"):
+        current[1].release()
+    readback = readback_create(mode)
+    screenstream_ctx["readback"] = (mode, readback)
+    return readback
+
+
+def _flush_readback(*largs):
+    trigger = screenstream_ctx["flush_trigger"]
+    if trigger is None:
+        from kivy.clock import Clock
+
+        def _flush(dt):
+            screenstream_ctx["flushing"] = True
+            screenstream_ctx["window"].canvas.ask_update()
+
+        trigger = Clock.create_trigger(_flush, .05)
+        screenstream_ctx["flush_trigger"] = trigger
+    trigger()
+
+
+def _redraw_later(timeout):
+    if screenstream_ctx["throttle_pending"]:
+        return
+    trigger = screenstream_ctx["throttle_trigger"]
+    if trigger is None:
+        from kivy.clock import Clock
+
+        def _redraw(dt):
+            screenstream_ctx["throttle_pending"] = False
+            screenstream_ctx["window"].canvas.ask_update()
+
+        trigger = Clock.create_trigger(_redraw, timeout)
+        screenstream_ctx["throttle_trigger"] = trigger
+    trigger.timeout = timeout
+    screenstream_ctx["throttle_pending"] = True
+    trigger()
+
+
+def _scale(width, height, pixels, scale):
+    # nearest neighbour, by slices when scale is 1/n, else by resampling
+    # to round(size * scale)
+    if scale >= 1.:
+        return width, height, pixels
+    step = int(round(1. / scale))
+    if abs(step * scale - 1.) < 1e-6:
+        return _downscale(width, height, pixels, step)
+    return _resample(width, height, pixels,
+                     max(1, int(round(width * scale))),
+                     max(1, int(round(height * scale))))
+
+
+def _resample(width, height, pixels, out_width, out_height):
+    # the bytes to keep in a row are picked by a single itemgetter, built
+    # once per frame, and each kept row is read once
+    stride = width * 3
+    columns = [x * width // out_width for x in range(out_width)]
+    pick = itemgetter(*[column * 3 + channel for column in columns
+                        for channel in range(3)])
+    out = bytearray()
+    last_y = row = None
+    for out_y in range(out_height):
+        y = out_y * height // out_height
+        if y != last_y:
+            row = bytes(bytearray(pick(bytearray(
+                pixels[y * stride:(y + 1) * stride]))))
+            last_y = y
+        out += row
+    return out_width, out_height, bytes(out)
+
+
+def _downscale(width, height, pixels, step):
+    # nearest neighbour: keep one pixel every `step` in both directions,
+    # copying with slices so it stays out of the python loop per pixel
+    stride = width * 3
+    out_width = (width + step - 1) // step
+    out_height = (height + step - 1) // step
+    out_stride = out_width * 3
+    out = bytearray(out_stride * out_height)
+    for out_y, y in enumerate(range(0, height, step)):
+        row = pixels[y * stride:(y + 1) * stride]
+        offset = out_y * out_stride
+        for channel in range(3):
+            out[offset + channel:offset + out_stride:3] = \
+                row[channel::3 * step]
+    return out_width, out_height, bytes(out)
+
+
+def _frame_seq_of(frame):
+    return frame.seq if frame is not None else None
+
+
+def screenstream_get_image(fmt, loader, frame=None):
+    if frame is None:
+        frame = screenstream_ctx["data"]
     bio = io.BytesIO()
-    loader.save(bio, width, height, pixelfmt, pixels, True, fmt)
+    with span("encode"):
+        loader.save(bio, frame.width, frame.height, frame.pixelfmt,
+                    frame.pixels, frame.flipped, fmt)
     return bio.read()
 
 
+class ScreenstreamEncoder(object):
+    """Encode each captured frame once per image format, on a worker
+    thread, and share the result between all the clients through a small
+    ring buffer. Clients always get the latest frame, slow ones skip the
+    frames they missed.
+    """
+
+    def __init__(self, size=4):
+        super(ScreenstreamEncoder, self).__init__()
+        self._ring = deque(maxlen=size)
+        self._cond = Condition()
+        # fmt -> [number of clients, loader]
+        self._formats = {}
+        self._thread = None
+
+    def acquire(self, fmt, loader):
+        with self._cond:
+            entry = self._formats.setdefault(fmt, [0, loader])
+            entry[0] += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def release(self, fmt):
+        with self._cond:
+            entry = self._formats[fmt]
+            entry[0] -= 1
+            if not entry[0]:
+                del self._formats[fmt]
+
+    def _latest(self, fmt):
+        for encoded in reversed(self._ring):
+            if encoded.fmt == fmt:
+                return encoded
+
+    def wait(self, fmt, after_seq=None, timeout=None):
+        """Return the latest frame encoded in `fmt` newer than `after_seq`,
+        or None if none came within `timeout` seconds.
+        """
+        def _ready():
+            encoded = self._latest(fmt)
+            if encoded is not None and (
+                    after_seq is None or encoded.seq > after_seq):
+                return encoded
+
+        with self._cond:
+            return wait_until(self._cond, _ready, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._formats:
+                    self._thread = None
+                    return
+                formats = list(self._formats.items())
+
+            # this thread is the only writer of the ring, no lock needed
+            with screenstream_frame_cond:
+                frame = screenstream_ctx["data"]
+                jobs = [
+                    (fmt, loader) for fmt, (clients, loader) in formats
+                    if frame is not None and
+                    _frame_seq_of(self._latest(fmt)) != frame.seq]
+                if not jobs:
+                    # the timeout is to notice when all the clients left
+                    screenstream_frame_cond.wait(1.)
+                    continue
+
+            for fmt, loader in jobs:
+                # a failed encoding is shared too, to not retry it forever
+                try:
+                    image = screenstream_get_image(fmt, loader, frame)
+                except Exception:
+                    traceback.print_exc()
+                    image = None
+                with self._cond:
+                    self._ring.append(EncodedFrame(frame.seq, fmt, image))
+                    self._cond.notify_all()
+
+
+screenstream_encoder = ScreenstreamEncoder()
+
+
+@route('/screenstream/config', methods=['GET', 'POST'])
+def kivy_screenstream_config():
+    if request.method == 'POST':
+        try:
+            content_hash = request.form.get('hash')
+            if content_hash is not None:
+                content_hash = content_hash not in ('', '0', 'false')
+            screenstream_configure(
+                max_fps=request.form.get('max_fps'),
+                scale=request.form.get('scale'),
+                content_hash=content_hash,
+                readback=request.form.get('readback'))
+        except ValueError as e:
+            return api_error(str(e))
+    return api_response({
+        'max_fps': screenstream_ctx['max_fps'],
+        'scale': screenstream_ctx['scale'],
+        'hash': screenstream_ctx['hash'],
+        'readback': screenstream_ctx['readback_mode'],
+        'subscribers': screenstream_ctx['subscribers'],
+    })
+
+
+def _screenshot_response(fmt, data):
+    if fmt == 'png':
+        mimetype = 'image/png'
+    elif fmt == 'jpg':
+        mimetype = 'image/jpeg'
+    return Response(data, mimetype=mimetype)
+
+
 @route("/screenshot/<fmt>")
 def kivy_screenshot(fmt):
+    """Screenshot of the window. To capture only a region, pass either a
+    `selector` or the `x`, `y`, `w`, `h` rectangle in window coordinates,
+    and optionally a `scale` (0 to 1).
+    """
     if not screenstream_install(fmt):
         return abort(500)
 
@@ -72,26 +567,147 @@ def kivy_screenshot(fmt):
     if not loader:
         return abort(500)
 
-    last_data = screenstream_ctx["data"]
-    screenstream_ctx["window"].canvas.ask_update()
-
-    # wait the image to change
-    while True:
-        # busy sleep if there is no update
-        data = screenstream_ctx["data"]
-        if data != last_data:
-            break
-        sleep(0.016)
+    args = request.args
+    if any(key in args for key in ('selector', 'x', 'y', 'w', 'h', 'scale')):
+        return _screenshot_region(fmt, loader)
+
+    screenstream_subscribe()
+    screenstream_encoder.acquire(fmt, loader)
+    try:
+        # wait for a capture, then for its encoding
+        frame = screenstream_next_frame(timeout=SCREENSHOT_TIMEOUT)
+        encoded = None
+        if frame is not None:
+            encoded = screenstream_encoder.wait(
+                fmt, frame.seq - 1, timeout=SCREENSHOT_TIMEOUT)
+    finally:
+        screenstream_encoder.release(fmt)
+        screenstream_unsubscribe()
+
+    if encoded is None or not encoded.data:
+        return abort(500)
+    return _screenshot_response(fmt, encoded.data)
+
+
+def _screenshot_region(fmt, loader):
+    args = request.args
+    selector = args.get('selector')
+    rect = None
+    try:
+        scale = min(1., max(0.01, float(args.get('scale', 1))))
+        if not selector:
+            window = screenstream_ctx["window"]
+            rect = (float(args.get('x', 0)), float(args.get('y', 0)),
+                    float(args.get('w', window.width)),
+                    float(args.get('h', window.height)))
+    except ValueError as e:
+        return api_error(str(e))
+    if selector:
+        # parse errors are plain exceptions, catch them before the capture
+        # re-raises them here; the compiled selector is cached for it
+        try:
+            compile_xpath(selector)
+        except Exception as e:
+            return api_error('Invalid `selector`: {}'.format(e))
+
+    try:
+        frame = screenstream_capture_region(
+            rect=rect, selector=selector, scale=scale,
+            timeout=SCREENSHOT_TIMEOUT)
+    except ValueError as e:
+        return api_error(str(e))
+    if frame is None:
+        return abort(500)
 
-    data = screenstream_get_image(fmt, loader)
+    data = screenstream_get_image(fmt, loader, frame)
     if not data:
         return abort(500)
+    return _screenshot_response(fmt, data)
 
-    if fmt == 'png':
-        mimetype = 'image/png'
-    elif fmt == 'jpg':
-        mimetype = 'image/jpeg'
-    return Response(data, mimetype=mimetype)
+
+@route('/screenshot/raw')
+def kivy_screenshot_raw():
+    """Next captured frame as raw pixels, described by the X-Width,
+    X-Height, X-Stride, X-Pixel-Format and X-Flipped (rows bottom-up)
+    headers.
+    """
+    if not screenstream_install():
+        return abort(500)
+
+    screenstream_subscribe()
+    try:
+        frame = screenstream_next_frame(timeout=SCREENSHOT_TIMEOUT)
+    finally:
+        screenstream_unsubscribe()
+    if frame is None:
+        return abort(500)
+
+    # the captured buffer is sent as is, without any copy or encoding
+    pixels = frame.pixels
+    return Response([pixels], mimetype='application/octet-stream',
+                    direct_passthrough=True, headers={
+                        'Content-Length': str(len(pixels)),
+                        'X-Width': str(frame.width),
+                        'X-Height': str(frame.height),
+                        'X-Stride': str(len(pixels) // frame.height),
+                        'X-Pixel-Format': frame.pixelfmt,
+                        'X-Flipped': '1' if frame.flipped else '0',
+                        'X-Frame-Seq': str(frame.seq),
+                        'X-Frame-Timestamp': repr(frame.timestamp),
+                    })
+
+
+def _shm_publish(ring):
+    last_seq = None
+    screenstream_subscribe()
+    try:
+        screenstream_ctx["window"].canvas.ask_update()
+        while screenstream_ctx["shm"] is ring:
+            frame = screenstream_wait_frame(last_seq, timeout=1.)
+            if frame is None:
+                continue
+            last_seq = frame.seq
+            ring.publish(frame.seq, frame.timestamp, frame.width,
+                         frame.height, frame.pixels, frame.flipped)
+    finally:
+        screenstream_unsubscribe()
+        ring.close()
+
+
+@route('/screenshot/shm', methods=['GET', 'POST'])
+def kivy_screenshot_shm():
+    """Publish the captured frames to a shared memory ring, for consumers
+    on the same host (see ncis_kivy.shm.FrameRingReader). POST `enabled`
+    (1 or 0), and optionally `slots` and `slot_size` (bytes per frame,
+    defaults to the window size).
+    """
+    if request.method == 'POST':
+        enabled = request.form.get('enabled', '1') not in ('0', 'false')
+        ring = screenstream_ctx["shm"]
+        if not enabled and ring is not None:
+            # the publisher thread stops and closes it
+            screenstream_ctx["shm"] = None
+        elif enabled and ring is None:
+            try:
+                from ncis_kivy.shm import FrameRing
+            except ImportError:
+                return api_error('Shared memory requires Python 3.8')
+            if not screenstream_install():
+                return abort(500)
+            width, height = screenstream_ctx["window"].size
+            try:
+                ring = FrameRing(
+                    int(request.form.get('slot_size', width * height * 3)),
+                    slots=int(request.form.get('slots', 4)))
+            except ValueError as e:
+                return api_error(str(e))
+            screenstream_ctx["shm"] = ring
+            thread = Thread(target=_shm_publish, args=(ring, ))
+            thread.daemon = True
+            thread.start()
+
+    ring = screenstream_ctx["shm"]
+    return api_response(ring.describe() if ring is not None else None)
 
 
 @route('/screenstream/<fmt>')
@@ -107,34 +723,91 @@ def kivy_screenstream(fmt):
         return abort(500)
 
     def _stream():
-        last_data = None
-        window.canvas.ask_update()
-        while True:
-
-            # busy sleep if there is no update
-            data = screenstream_ctx["data"]
-            if data == last_data:
-                yield ''
-                sleep(0.016)
-                continue
-            last_data = data
-
-            image = screenstream_get_image(fmt, loader)
-            if not image:
-                continue
-
-            # convert and send
-            yield '--{}\r\n'.format(boundary)
-            if fmt == 'jpg':
-                yield 'Content-Type: image/jpeg\r\n'
-            elif fmt == 'png':
-                yield 'Content-Type: image/png\r\n'
-            yield 'Content-Length: %d\r\n\r\n' % len(image)
-            yield image
-
+        last_seq = None
+        screenstream_subscribe()
+        screenstream_encoder.acquire(fmt, loader)
+        try:
+            window.canvas.ask_update()
+            image = None
+            while True:
+
+                # the frame is encoded once for all the clients, if none
+                # came send the last one again to detect disconnections.
+                # A disconnection closes this generator at its next yield.
+                encoded = screenstream_encoder.wait(
+                    fmt, last_seq, timeout=SCREENSTREAM_KEEPALIVE)
+                if encoded is not None:
+                    last_seq = encoded.seq
+                    if encoded.data:
+                        image = encoded.data
+                    else:
+                        continue
+                elif image is None:
+                    continue
+
+                # convert and send
+                yield '--{}\r\n'.format(boundary)
+                if fmt == 'jpg':
+                    yield 'Content-Type: image/jpeg\r\n'
+                elif fmt == 'png':
+                    yield 'Content-Type: image/png\r\n'
+                yield 'Content-Length: %d\r\n\r\n' % len(image)
+                yield image
+        finally:
+            screenstream_encoder.release(fmt)
+            screenstream_unsubscribe()
 
     return Response(_stream(), headers={
         'Content-type': 'multipart/x-mixed-replace; boundary={}'.format(
             boundary
         )
     })
+
+
+@route('/screenstream/delta')
+def kivy_screenstream_delta():
+    """Stream the window as the tiles changed since the previous frame,
+    with a keyframe on connection and then every `keyframe` seconds. The
+    format is described in :mod:`ncis_kivy.delta`. Optional `tile` (size
+    in pixels, default 32) and `keyframe` (default 10) parameters.
+    """
+    try:
+        from ncis_kivy.delta import DeltaEncoder
+    except ImportError:
+        return api_error('NumPy is required for the delta screenstream')
+
+    try:
+        tile = int(request.args.get('tile', 32))
+        keyframe = float(request.args.get('keyframe', 10))
+    except ValueError as e:
+        return api_error(str(e))
+    if not 8 <= tile <= 1024:
+        return api_error('Invalid `tile`')
+
+    if not screenstream_install():
+        return abort(500)
+    window = screenstream_ctx["window"]
+
+    def _stream():
+        encoder = DeltaEncoder(tile=tile, keyframe_interval=keyframe)
+        last_seq = None
+        screenstream_subscribe()
+        try:
+            window.canvas.ask_update()
+            while True:
+                frame = screenstream_wait_frame(
+                    last_seq, timeout=SCREENSTREAM_KEEPALIVE)
+                if frame is None:
+                    message = encoder.keepalive(last_seq)
+                else:
+                    last_seq = frame.seq
+                    with span("encode"):
+                        message = encoder.encode(
+                            frame.seq, frame.timestamp, frame.width,
+                            frame.height, frame.pixels, frame.flipped)
+                if message:
+                    yield message
+        finally:
+            screenstream_unsubscribe()
+
+    return Response(_stream(), mimetype='application/octet-stream')
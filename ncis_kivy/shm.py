@@ -0,0 +1,136 @@
+# coding=utf-8
+"""
+Shared memory frames
+====================
+
+Ring of captured frames in a `multiprocessing.shared_memory` block, so
+consumers on the same host can map the pixels without any HTTP copy.
+Requires Python 3.8.
+
+Layout, little-endian::
+
+    ring header (64 bytes)
+        4s  magic "NCSH"
+        I   version (1)
+        I   number of slots
+        Q   slot size (pixels bytes)
+        Q   number of frames written, the latest one is in the slot
+            (written - 1) % slots
+    then for each slot
+        slot header (32 bytes)
+            Q   frame sequence number, 0 while the slot is being written
+            d   timestamp
+            I   width
+            I   height
+            I   stride
+            I   flags, 1 if the rows are bottom-up
+        pixels (slot size bytes)
+
+A reader copies the slot, then checks that its sequence number did not
+change during the copy, see `FrameRingReader`.
+"""
+
+import struct
+from multiprocessing import shared_memory
+
+MAGIC = b"NCSH"
+VERSION = 1
+RING_HEADER = struct.Struct("<4sIIQQ")
+RING_HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<QdIIII")
+SLOT_HEADER_SIZE = 32
+SEQ = struct.Struct("<Q")
+WRITTEN_OFFSET = 20
+FLAG_FLIPPED = 1
+
+
+def _slot_offset(index, slot_size):
+    return RING_HEADER_SIZE + index * (SLOT_HEADER_SIZE + slot_size)
+
+
+class FrameRing(object):
+    """Writer side of the ring.
+    """
+
+    def __init__(self, slot_size, slots=4, name=None):
+        super(FrameRing, self).__init__()
+        self.slots = slots
+        self.slot_size = slot_size
+        self.written = 0
+        self.dropped = 0
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=True,
+            size=_slot_offset(slots, slot_size))
+        RING_HEADER.pack_into(
+            self.shm.buf, 0, MAGIC, VERSION, slots, slot_size, 0)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def publish(self, seq, timestamp, width, height, pixels, flipped):
+        size = len(pixels)
+        if size > self.slot_size:
+            self.dropped += 1
+            return False
+        buf = self.shm.buf
+        offset = _slot_offset(self.written % self.slots, self.slot_size)
+        SEQ.pack_into(buf, offset, 0)
+        data = offset + SLOT_HEADER_SIZE
+        buf[data:data + size] = pixels
+        SLOT_HEADER.pack_into(
+            buf, offset, seq, timestamp, width, height, size // height,
+            FLAG_FLIPPED if flipped else 0)
+        self.written += 1
+        SEQ.pack_into(buf, WRITTEN_OFFSET, self.written)
+        return True
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def describe(self):
+        return {
+            "name": self.name,
+            "slots": self.slots,
+            "slot_size": self.slot_size,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+class FrameRingReader(object):
+    """Reader side of the ring, for consumers on the same host.
+    """
+
+    def __init__(self, name):
+        super(FrameRingReader, self).__init__()
+        self.shm = shared_memory.SharedMemory(name=name)
+        magic, version, self.slots, self.slot_size, _ = \
+            RING_HEADER.unpack_from(self.shm.buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Invalid frame ring {!r}".format(name))
+
+    def latest(self):
+        """Return the latest frame as (seq, timestamp, width, height,
+        stride, flipped, pixels), or None if there is no frame yet or it
+        was overwritten while reading.
+        """
+        buf = self.shm.buf
+        written = SEQ.unpack_from(buf, WRITTEN_OFFSET)[0]
+        if not written:
+            return
+        offset = _slot_offset((written - 1) % self.slots, self.slot_size)
+        seq, timestamp, width, height, stride, flags = \
+            SLOT_HEADER.unpack_from(buf, offset)
+        if not seq:
+            return
+        data = offset + SLOT_HEADER_SIZE
+        pixels = bytes(buf[data:data + stride * height])
+        if SEQ.unpack_from(buf, offset)[0] != seq:
+            return
+        return (seq, timestamp, width, height, stride,
+                bool(flags & FLAG_FLIPPED), pixels)
+
+    def close(self):
+        self.shm.close()
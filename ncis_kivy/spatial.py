@@ -0,0 +1,204 @@
+# coding=utf-8
+"""
+Spatial index
+=============
+
+Window-space bounding boxes of all the widgets, stored in NumPy arrays, so
+point and rectangle queries are answered with vectorised comparisons
+instead of calling `collide_point` and `to_local` on every widget. Requires
+NumPy.
+
+The boxes are built in one walk of the tree, then reused until the `pos`,
+`size` or `children` of a widget change. Boxes are the window coordinates of
+the bottom-left and top-right corners, like `widget_bounds`: exact through
+translations (RelativeLayout, ScrollView), approximate for a rotated
+Scatter.
+"""
+
+import weakref
+import numpy as np
+from ncis_kivy.utils import widget_bounds
+
+spatial_index = None
+
+
+class SpatialSnapshot(object):
+    """Boxes of the tree under `root` at one point in time. Built on the
+    Kivy thread, then only read, so it can be queried from any thread.
+    """
+
+    def __init__(self, root):
+        super(SpatialSnapshot, self).__init__()
+        widgets = []
+        parents = []
+        depths = []
+        boxes = []
+        visible = []
+        # document order, the root itself excluded
+        stack = [(child, -1, 0) for child in reversed(root.children)]
+        while stack:
+            widget, parent, depth = stack.pop()
+            position = len(widgets)
+            widgets.append(widget)
+            parents.append(parent)
+            depths.append(depth)
+            boxes.append(widget_bounds(widget))
+            # like pick_widget, invisible widgets can't be picked
+            visible.append(
+                not (hasattr(widget, 'visible') and not widget.visible))
+            stack.extend((child, position, depth + 1)
+                         for child in reversed(widget.children))
+
+        count = len(widgets)
+        self.widgets = [weakref.ref(widget) for widget in widgets]
+        self.parent = np.array(parents, dtype=np.int64).reshape(count)
+        self.depth = np.array(depths, dtype=np.int64).reshape(count)
+        self.boxes = np.array(boxes, dtype=np.float64).reshape(count, 4)
+        self.visible = np.array(visible, dtype=bool).reshape(count)
+        # indices of the widgets of each depth, to propagate along parents
+        self._levels = [np.flatnonzero(self.depth == depth)
+                        for depth in range(1, int(self.depth.max()) + 1)] \
+            if count else []
+
+        # order of collide_at: the roots in order, then the children of
+        # each widget from the last one
+        ids = {id(widget): position
+               for position, widget in enumerate(widgets)}
+        order = np.empty(count, dtype=np.int64)
+        stack = list(reversed(root.children))
+        rank = 0
+        while stack:
+            widget = stack.pop()
+            order[ids[id(widget)]] = rank
+            rank += 1
+            stack.extend(widget.children)
+        self.collide_order = order
+
+    def __len__(self):
+        return len(self.widgets)
+
+    def _widgets(self, positions):
+        widgets = (self.widgets[position]() for position in positions)
+        return [widget for widget in widgets if widget is not None]
+
+    def _inside(self, x, y):
+        boxes = self.boxes
+        return ((boxes[:, 0] <= x) & (x <= boxes[:, 2]) &
+                (boxes[:, 1] <= y) & (y <= boxes[:, 3]))
+
+    def _chain(self, mask):
+        # keep only the widgets whose ancestors are all in the mask
+        mask = mask.copy()
+        parent = self.parent
+        for level in self._levels:
+            mask[level] &= mask[parent[level]]
+        return mask
+
+    def pick(self, x, y):
+        """Return the widget `pick_widget` would pick at (x, y), in window
+        coordinates, from the topmost window child, or None.
+        """
+        hits = np.flatnonzero(self._chain(self._inside(x, y) & self.visible))
+        if not len(hits):
+            return
+        # in document order, the first hit child of a hit widget is the next
+        # hit, the picked widget is the end of this chain
+        breaks = np.flatnonzero(self.parent[hits[1:]] != hits[:-1])
+        end = breaks[0] if len(breaks) else len(hits) - 1
+        return self.widgets[hits[end]]()
+
+    def collide(self, x, y):
+        """Return the widgets `collide_at` would return at (x, y) for each
+        window child: the deepest colliding widgets, in its order.
+        """
+        hit = self._chain(self._inside(x, y))
+        has_hit_child = np.zeros(len(hit), dtype=bool)
+        parents = self.parent[hit]
+        has_hit_child[parents[parents >= 0]] = True
+        leaves = np.flatnonzero(hit & ~has_hit_child)
+        leaves = leaves[np.argsort(self.collide_order[leaves])]
+        return self._widgets(leaves)
+
+    def overlap(self, left, bottom, right, top):
+        """Return the visible widgets whose box intersects the rectangle, in
+        document order.
+        """
+        boxes = self.boxes
+        mask = ((boxes[:, 0] <= right) & (left <= boxes[:, 2]) &
+                (boxes[:, 1] <= top) & (bottom <= boxes[:, 3]))
+        return self._widgets(np.flatnonzero(mask & self._chain(self.visible)))
+
+
+class SpatialIndex(object):
+    """Rebuilds the snapshot of the Window tree when it is requested after a
+    layout or structural change.
+    """
+
+    WATCHED = ('pos', 'size', 'children')
+
+    def __init__(self):
+        super(SpatialIndex, self).__init__()
+        self.builds = 0
+        self._snapshot = None
+        self._dirty = True
+        # (widget ref, [(property, uid)])
+        self._bound = []
+
+    def snapshot(self):
+        """Return an up to date snapshot. Must be called from the Kivy
+        thread.
+        """
+        if self._dirty or self._snapshot is None:
+            self._rebuild()
+        return self._snapshot
+
+    def _rebuild(self):
+        from kivy.core.window import Window
+        self._unbind()
+        snapshot = SpatialSnapshot(Window)
+        self._bind(Window, ('children', ))
+        for ref in snapshot.widgets:
+            self._bind(ref(), self.WATCHED)
+        self._snapshot = snapshot
+        self._dirty = False
+        self.builds += 1
+
+    def _bind(self, widget, names):
+        uids = [(name, widget.fbind(name, self._invalidate))
+                for name in names]
+        self._bound.append((weakref.ref(widget), uids))
+
+    def _unbind(self):
+        for ref, uids in self._bound:
+            widget = ref()
+            if widget is None:
+                continue
+            for name, uid in uids:
+                if uid:
+                    widget.unbind_uid(name, uid)
+        self._bound = []
+
+    def _invalidate(self, *largs):
+        self._dirty = True
+
+    def uninstall(self):
+        self._unbind()
+        self._snapshot = None
+        self._dirty = True
+
+    def stats(self):
+        return {
+            'widgets': len(self._snapshot) if self._snapshot else 0,
+            'builds': self.builds,
+            'dirty': self._dirty,
+        }
+
+
+def spatial_snapshot():
+    """Return an up to date snapshot of the Window tree, installing the
+    spatial index if needed. Must be called from the Kivy thread.
+    """
+    global spatial_index
+    if spatial_index is None:
+        spatial_index = SpatialIndex()
+    return spatial_index.snapshot()
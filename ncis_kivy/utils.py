@@ -1,4 +1,9 @@
-from threading import Event
+from functools import wraps
+from time import time
+from ncis_kivy.dispatcher import dispatcher
+from ncis_kivy.metrics import span
+from ncis_kivy.xpath import compile_xpath
+from ncis_kivy.index import current_index, sibling_positions
 
 app = None
 
@@ -12,19 +17,169 @@ def kivyapp():
     return app
 
 
-def kivythread(f):
+def kivythread(f, timeout=None):
+    """Decorate `f` to run it on the Kivy thread, through the dispatcher.
+    The call returns its result or raises its exception, and raises
+    `concurrent.futures.TimeoutError` after `timeout` seconds.
+    """
+    @wraps(f)
     def f2(*args, **kwargs):
-        ev = Event()
-        ev_value = Event()
+        return dispatcher.call(f, args, kwargs, timeout=timeout)
 
-        def custom_call(dt):
-            if f(*args, **kwargs):
-                ev_value.set()
-            ev.set()
+    return f2
 
-        from kivy.clock import Clock
-        Clock.schedule_once(custom_call, 0)
-        ev.wait()
-        return ev_value.is_set()
 
-    return f2
+def wait_until(cond, predicate, timeout=None):
+    """Wait on `cond`, which must be held, until `predicate()` is true or
+    `timeout` seconds passed, and return the last value of the predicate,
+    like `Condition.wait_for`, which Python 2.7 doesn't have.
+    """
+    result = predicate()
+    deadline = None if timeout is None else time() + timeout
+    while not result:
+        if deadline is None:
+            cond.wait()
+        else:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            cond.wait(remaining)
+        result = predicate()
+    return result
+
+
+def select_all(selector, root=None, limit=None, index=None):
+    app = kivyapp()
+    if not app:
+        return []
+    if root is None:
+        root = app.root.parent
+    if index is None:
+        index = current_index()
+    matches = compile_xpath(selector)
+    with span("traverse"):
+        matches = matches.execute(root, index=index, limit=limit)
+    return matches or []
+
+
+def select_first(selector, root=None, index=None):
+    app = kivyapp()
+    if not app:
+        return
+    if root is None:
+        root = app.root.parent
+    if index is None:
+        index = current_index()
+    selector = compile_xpath(selector)
+    with span("traverse"):
+        return selector.select_first(root, index=index)
+
+
+def widget_bounds(widget):
+    """Return the (left, bottom, right, top) bounds of `widget` in window
+    coordinates.
+    """
+    left, bottom = widget.to_window(widget.x, widget.y)
+    right, top = widget.to_window(
+        widget.x + widget.width, widget.y + widget.height)
+    return (left, bottom, right, top)
+
+
+def pick_widget(widget, x, y):
+    """Return the topmost visible widget at (x, y) in the subtree of
+    `widget`, (x, y) being in its parent coordinates, or None.
+    """
+    ret = None
+    # try to filter widgets that are not visible (invalid inspect target)
+    if (hasattr(widget, 'visible') and not widget.visible):
+        return ret
+    if widget.collide_point(x, y):
+        ret = widget
+        x2, y2 = widget.to_local(x, y)
+        # reverse the loop - look at children on top first
+        for child in reversed(widget.children):
+            ret = pick_widget(child, x2, y2) or ret
+    return ret
+
+
+def collide_at(widget, x, y):
+    """Iterate the deepest widgets colliding with (x, y) in the subtree of
+    `widget`, (x, y) being in its parent coordinates.
+    """
+    if widget.collide_point(x, y):
+        x2, y2 = widget.to_local(x, y)
+        have_results = False
+        for child in reversed(widget.children):
+            for ret in collide_at(child, x2, y2):
+                yield ret
+                have_results = True
+        if not have_results:
+            yield widget
+
+
+def pick_at(x, y, all=False):
+    """Return the widget at (x, y) in window coordinates as a list, from the
+    topmost window child, or with `all` the deepest widgets colliding there.
+    Walks the tree, see `ncis_kivy.spatial` for the indexed version.
+    """
+    from kivy.core.window import Window
+    if all:
+        widgets = []
+        for widget in Window.children:
+            widgets.extend(collide_at(widget, x, y))
+        return widgets
+    for widget in Window.children:
+        widget = pick_widget(widget, x, y)
+        if widget is not None:
+            return [widget]
+    return []
+
+
+def widget_paths(widgets, index=None):
+    """Return the paths of `widgets`, like /BoxLayout/Button[0], the index
+    being the position of the widget in the children of its parent.
+
+    The paths of the ancestors are computed once for the whole result set,
+    and the positions come from one map per parent, cached by the index if
+    there is one.
+    """
+    from kivy.core.window import Window
+    if index is None:
+        index = current_index()
+    siblings = {}
+    paths = {}
+
+    def position(parent, widget):
+        positions = siblings.get(id(parent))
+        if positions is None:
+            if index is not None:
+                positions = index.siblings(parent)
+            if positions is None:
+                positions = sibling_positions(parent.children)
+            siblings[id(parent)] = positions
+        try:
+            return positions[id(widget)]
+        except KeyError:
+            # the children changed since the positions were built
+            return parent.children.index(widget)
+
+    results = []
+    with span("path_build"):
+        for widget in widgets:
+            # climb up to an ancestor with a known path
+            chain = []
+            node = widget
+            while id(node) not in paths:
+                parent = node.parent
+                if parent is Window or parent == node or not parent:
+                    paths[id(node)] = "/{}".format(node.__class__.__name__)
+                    break
+                chain.append(node)
+                node = parent
+            for node in reversed(chain):
+                parent = node.parent
+                paths[id(node)] = "{}/{}[{}]".format(
+                    paths[id(parent)], node.__class__.__name__,
+                    position(parent, node))
+            results.append(paths[id(widget)])
+    return results
@@ -2,41 +2,175 @@
 
 import re
 import json
+from collections import OrderedDict, deque
+from itertools import islice
+from threading import Lock
+from ncis_kivy.metrics import span
+
+
+def _parent_of(widget):
+    parent = getattr(widget, "parent", None)
+    if parent is widget:
+        return None
+    return parent
+
+
+def iter_tree(root, skip=None, enter=None):
+    """Iterate `root` and all its descendants in document order, using an
+    explicit stack. Subtrees whose top widget id is in `skip` are not
+    entered. If `enter` is given, only the widgets whose id is in it are
+    entered.
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if skip and node is not root and id(node) in skip:
+            continue
+        yield node
+        if enter is None:
+            stack.extend(reversed(node.children))
+        else:
+            stack.extend(child for child in reversed(node.children)
+                         if id(child) in enter)
+
+
+def iter_descendants(items, enter=None):
+    """Iterate the subtrees of all `items` (items included), each widget
+    once. When `items` are in document order, so is the result. `enter` is
+    passed to :func:`iter_tree`.
+    """
+    walked = set()
+    for item in items:
+        # an item inside an already walked subtree has nothing new to give
+        node = item
+        while node is not None and id(node) not in walked:
+            node = _parent_of(node)
+        if node is not None:
+            continue
+        walked.add(id(item))
+        # skip the subtrees walked before, in case items were not ordered
+        for node in iter_tree(item, skip=walked, enter=enter):
+            yield node
+
+
+def _branches(nodes, root):
+    # ids of all the ancestors of `nodes`, up to `root`
+    branches = set()
+    for node in nodes:
+        node = _parent_of(node)
+        while node is not None and id(node) not in branches:
+            branches.add(id(node))
+            if node is root:
+                break
+            node = _parent_of(node)
+    return branches
+
+
+def iter_children(root, items):
+    """Iterate the children of all `items` in document order. `items` must
+    be in document order, and are consumed lazily: the walk from `root`
+    only enters the items already reached and the branch leading to the
+    next one.
+    """
+    items = iter(items)
+    parents = set()
+
+    def next_pending():
+        for item in items:
+            if id(item) not in parents:
+                return item, _branches([item], root)
+        return None, ()
+
+    pending, towards = next_pending()
+    stack = [(root, False)]
+    while stack:
+        node, is_child = stack.pop()
+        if is_child:
+            yield node
+        while node is pending:
+            parents.add(id(node))
+            pending, towards = next_pending()
+        key = id(node)
+        if key in parents:
+            stack.extend((child, True) for child in reversed(node.children))
+        elif key in towards:
+            stack.extend((child, False) for child in reversed(node.children))
+
+
+def get_bases(cls):
+    for base in cls.__bases__:
+        if base.__name__ == 'object':
+            break
+        yield base
+        if base.__name__ == 'Widget':
+            break
+        for cbase in get_bases(base):
+            yield cbase
+
+
+# class -> frozenset of the names matched by ~ClassName for its instances
+_class_names = {}
+
+
+def class_names(cls):
+    """Return the names of `cls` and of its bases (up to Widget), cached per
+    class.
+    """
+    names = _class_names.get(cls)
+    if names is None:
+        names = frozenset(
+            [cls.__name__] + [base.__name__ for base in get_bases(cls)])
+        _class_names[cls] = names
+    return names
 
 
 class Selector(object):
+    # selectors are shared between request threads once compiled, so they
+    # are frozen at the end of their construction
+    _frozen = False
+
     def __init__(self, **kwargs):
         super(Selector, self).__init__()
         for key, value in kwargs.items():
             setattr(self, key, value)
+        self._frozen = True
+
+    def __setattr__(self, key, value):
+        if self._frozen:
+            raise AttributeError("{!r} is immutable".format(self))
+        super(Selector, self).__setattr__(key, value)
 
     def traverse_tree(self, root):
         if not root:
             return
-        yield root
-        for child in root.children:
-            for result in self.traverse_tree(child):
-                yield result
+        for result in iter_tree(root):
+            yield result
 
     def match_class(self, widget, classname):
         if not classname.startswith("~"):
             return widget.__class__.__name__ == classname
-        bases = [widget.__class__] + list(self.get_bases(widget.__class__))
-        bases = [cls.__name__ for cls in bases]
-        return classname[1:] in bases
+        return classname[1:] in class_names(widget.__class__)
 
     def get_bases(self, cls):
-        for base in cls.__bases__:
-            if base.__name__ == 'object':
-                break
-            yield base
-            if base.__name__ == 'Widget':
-                break
-            for cbase in self.get_bases(base):
-                yield cbase
-
-    def execute(self, root):
-        return list(self.filter(root, [root]))
+        return get_bases(cls)
+
+    def iterate(self, root, index=None):
+        """Lazily iterate the matches under `root`, in document order.
+        """
+        return self.filter(root, [root], index)
+
+    def execute(self, root, index=None, limit=None):
+        matches = self.iterate(root, index)
+        if limit is not None:
+            matches = islice(matches, limit)
+        return list(matches)
+
+    def select_first(self, root, index=None):
+        """Return the first match under `root` or None, without walking the
+        rest of the tree.
+        """
+        for match in self.iterate(root, index):
+            return match
 
     def __add__(self, other):
         return SequenceSelector(first=self, second=other)
@@ -46,9 +180,9 @@ class SequenceSelector(Selector):
     first = None
     second = None
 
-    def filter(self, root, items):
-        items = self.first.filter(root, items)
-        items = self.second.filter(root, items)
+    def filter(self, root, items, index=None):
+        items = self.first.filter(root, items, index)
+        items = self.second.filter(root, items, index)
         return items
 
     def __repr__(self):
@@ -58,13 +192,40 @@ class SequenceSelector(Selector):
 class AllClassSelector(Selector):
     classname = None
 
-    def filter(self, root, items):
-        if not items:
-            items = [self.root]
-        for item in items:
-            for match_item in self.traverse_tree(item):
-                if self.match_class(match_item, self.classname):
-                    yield match_item
+    def filter(self, root, items, index=None):
+        candidates = None
+        if index is not None:
+            candidates = index.lookup(self.classname, root)
+        if candidates is None:
+            return self.filter_all(items)
+        if not index.debug:
+            return self.filter_indexed(items, candidates, index.root)
+
+        # debug mode, check the index against a full traversal
+        items = list(items)
+        expected = list(self.filter_all(items))
+        indexed = list(self.filter_indexed(items, candidates, index.root))
+        if expected != indexed:
+            index.inconsistent(self, expected, indexed)
+        return iter(expected)
+
+    def filter_all(self, items):
+        match_class = self.match_class
+        classname = self.classname
+        for match_item in iter_descendants(items):
+            if match_class(match_item, classname):
+                yield match_item
+
+    def filter_indexed(self, items, candidates, index_root):
+        # only walk the branches leading to the candidates
+        enter = _branches(candidates.values(), index_root)
+        enter.update(candidates)
+        match_class = self.match_class
+        classname = self.classname
+        for match_item in iter_descendants(items, enter=enter):
+            if id(match_item) in candidates and \
+                    match_class(match_item, classname):
+                yield match_item
 
     def __repr__(self):
         return "AllClass(classname={})".format(self.classname)
@@ -73,12 +234,12 @@ class AllClassSelector(Selector):
 class ChildrenClassSelector(Selector):
     classname = None
 
-    def filter(self, root, items):
-        items = list(items)
-        for item in items:
-            for child in item.children:
-                if self.match_class(child, self.classname):
-                    yield child
+    def filter(self, root, items, index=None):
+        match_class = self.match_class
+        classname = self.classname
+        for child in iter_children(root, items):
+            if match_class(child, classname):
+                yield child
 
     def __repr__(self):
         return "ChildrenClass(classname={})".format(self.classname)
@@ -87,14 +248,13 @@ class ChildrenClassSelector(Selector):
 class IndexSelector(Selector):
     index = None
 
-    def filter(self, root, items):
-        try:
-            for index, item in enumerate(reversed(list(items))):
-                if index == self.index:
-                    yield item
-                    return
-        except IndexError:
+    def filter(self, root, items, index=None):
+        # the index counts from the last item, only keep the needed tail
+        if self.index < 0:
             return
+        tail = deque(items, maxlen=self.index + 1)
+        if len(tail) == self.index + 1:
+            yield tail[0]
 
     def __repr__(self):
         return "Index({})".format(self.index)
@@ -103,7 +263,7 @@ class IndexSelector(Selector):
 class AttrExistSelector(Selector):
     attr = None
 
-    def filter(self, root, items):
+    def filter(self, root, items, index=None):
         for item in items:
             if hasattr(item, self.attr):
                 yield item
@@ -116,11 +276,18 @@ class AttrOpSelector(Selector):
     attr = None
     op = None
     value = None
+    literal = None
+
+    def __init__(self, **kwargs):
+        # decode the literal once at parse time, not on every filter()
+        if "value" in kwargs:
+            kwargs.setdefault("literal", json.loads(kwargs["value"]))
+        super(AttrOpSelector, self).__init__(**kwargs)
 
-    def filter(self, root, items):
+    def filter(self, root, items, index=None):
         op = self.op
         attr = self.attr
-        value = json.loads(self.value)
+        value = self.literal
         for item in items:
             if not hasattr(item, attr):
                 continue
@@ -139,6 +306,43 @@ class AttrOpSelector(Selector):
                                                          self.value)
 
 
+class ObservedAttrSelector(Selector):
+    """Wraps an attribute selector to record the (widget, attribute) pairs
+    it examines, see `observe_attributes`.
+    """
+    selector = None
+    seen = None
+
+    def filter(self, root, items, index=None):
+        return self.selector.filter(root, self._record(items), index)
+
+    def _record(self, items):
+        attr = self.selector.attr
+        for item in items:
+            self.seen[(id(item), attr)] = (item, attr)
+            yield item
+
+    def __repr__(self):
+        return "Observed({!r})".format(self.selector)
+
+
+def observe_attributes(selector, seen):
+    """Return a copy of `selector` that adds the widgets examined by its
+    attribute predicates to the `seen` dict, as (id, attr) -> (widget, attr),
+    i.e. the properties its result depends on.
+    """
+    if isinstance(selector, (AttrExistSelector, AttrOpSelector)):
+        return ObservedAttrSelector(selector=selector, seen=seen)
+    fields = {}
+    for key, value in vars(selector).items():
+        if key == "_frozen":
+            continue
+        if isinstance(value, Selector):
+            value = observe_attributes(value, seen)
+        fields[key] = value
+    return selector.__class__(**fields)
+
+
 class XpathParser(object):
     WORD = re.compile("^([~\w]+)")
 
@@ -210,6 +414,66 @@ class XpathParser(object):
             raise Exception("Invalid syntax in {}".format(expr))
 
 
+class XpathCache(object):
+    """Bounded LRU of compiled selectors, keyed by the expression string.
+    Compiled selectors are immutable, so they can be shared between
+    threads.
+    """
+
+    def __init__(self, maxsize=512):
+        super(XpathCache, self).__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._plans = OrderedDict()
+        self._lock = Lock()
+
+    def compile(self, expr):
+        with self._lock:
+            plan = self._plans.pop(expr, None)
+            if plan is not None:
+                self._plans[expr] = plan
+                self.hits += 1
+                return plan
+            self.misses += 1
+
+        # parse outside the lock, a concurrent miss on the same expression
+        # just parses it twice
+        with span("parse"):
+            plan = XpathParser().parse(expr)
+
+        with self._lock:
+            self._plans[expr] = plan
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+                self.evictions += 1
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._plans),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+xpath_cache = XpathCache()
+
+
+def compile_xpath(expr):
+    """Return the compiled selector for `expr`, from the cache if possible.
+    """
+    return xpath_cache.compile(expr)
+
+
 if __name__ == "__main__":
     from kivy.lang import Builder
     root = Builder.load_string("""
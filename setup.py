@@ -31,7 +31,12 @@ setup(
         'Programming Language :: Python :: 3.7',
     ],
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
-    install_requires=['ncis'],
+    install_requires=['ncis', 'futures; python_version < "3"'],
+    extras_require={
+        'delta': ['numpy'],
+        'pbo': ['PyOpenGL'],
+        'spatial': ['numpy'],
+    },
     project_urls={
         'Bug Reports': 'https://github.com/kivy/ncis-kivy/issues',
         'Source': 'https://github.com/kivy/ncis-kivy/',
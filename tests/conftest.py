@@ -0,0 +1,16 @@
+# coding=utf-8
+"""
+The ncis_kivy modules are loaded from this checkout without running its
+__init__.py, which registers the routes and only works once ncis loaded the
+plugin.
+"""
+
+import os
+import sys
+import types
+
+if "ncis_kivy" not in sys.modules:
+    package = types.ModuleType("ncis_kivy")
+    package.__path__ = [os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), os.pardir, "ncis_kivy")]
+    sys.modules["ncis_kivy"] = package
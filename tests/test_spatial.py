@@ -0,0 +1,160 @@
+# coding=utf-8
+"""
+Differential check of the spatial index against the tree walks it replaces,
+`pick_widget` and `collide_at`, on random trees with relative layouts and
+invisible widgets.
+"""
+
+import sys
+import types
+import random
+import pytest
+
+pytest.importorskip("numpy")
+
+if "kivy.core.window" not in sys.modules:
+    for name in ("kivy", "kivy.core", "kivy.core.window"):
+        sys.modules.setdefault(name, types.ModuleType(name))
+
+from ncis_kivy import spatial  # noqa
+from ncis_kivy.utils import pick_at, widget_bounds  # noqa
+
+
+class Widget(object):
+    def __init__(self, x=0, y=0, width=100, height=100, relative=False,
+                 **kwargs):
+        super(Widget, self).__init__()
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        # a RelativeLayout: its children are positioned from its origin
+        self.relative = relative
+        self.parent = None
+        self.children = []
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def add_widget(self, widget, index=0):
+        widget.parent = self
+        self.children.insert(index, widget)
+
+    def collide_point(self, x, y):
+        return (self.x <= x <= self.x + self.width and
+                self.y <= y <= self.y + self.height)
+
+    def to_local(self, x, y):
+        if self.relative:
+            return x - self.x, y - self.y
+        return x, y
+
+    def to_parent(self, x, y):
+        if self.relative:
+            return x + self.x, y + self.y
+        return x, y
+
+    def to_window(self, x, y, initial=True):
+        if not initial:
+            x, y = self.to_parent(x, y)
+        if isinstance(self.parent, Widget):
+            return self.parent.to_window(x, y, initial=False)
+        return x, y
+
+    def fbind(self, name, callback):
+        return 1
+
+    def unbind_uid(self, name, uid):
+        pass
+
+
+class Window(object):
+    def __init__(self):
+        super(Window, self).__init__()
+        self.children = []
+
+    def add_widget(self, widget):
+        widget.parent = self
+        self.children.insert(0, widget)
+
+    def fbind(self, name, callback):
+        return 1
+
+    def unbind_uid(self, name, uid):
+        pass
+
+
+@pytest.fixture
+def window(monkeypatch):
+    window = Window()
+    monkeypatch.setattr(sys.modules["kivy.core.window"], "Window", window,
+                        raising=False)
+    return window
+
+
+def random_tree(rnd, window, size):
+    nodes = []
+    for _ in range(rnd.randint(1, 3)):
+        widget = Widget(rnd.uniform(0, 50), rnd.uniform(0, 50),
+                        rnd.uniform(50, 150), rnd.uniform(50, 150))
+        window.add_widget(widget)
+        nodes.append(widget)
+    for _ in range(size):
+        kwargs = {}
+        if rnd.random() < .3:
+            kwargs["visible"] = rnd.random() > .1
+        widget = Widget(rnd.uniform(-20, 100), rnd.uniform(-20, 100),
+                        rnd.uniform(5, 80), rnd.uniform(5, 80),
+                        relative=rnd.random() < .2, **kwargs)
+        parent = rnd.choice(nodes)
+        parent.add_widget(widget, rnd.randint(0, len(parent.children)))
+        nodes.append(widget)
+    return nodes
+
+
+def visible_chain(widget):
+    while isinstance(widget, Widget):
+        if hasattr(widget, "visible") and not widget.visible:
+            return False
+        widget = widget.parent
+    return True
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_trees(window, seed):
+    rnd = random.Random(seed)
+    nodes = random_tree(rnd, window, rnd.randint(0, 200))
+    snapshot = spatial.SpatialSnapshot(window)
+    assert len(snapshot) == len(nodes)
+    for _ in range(200):
+        x, y = rnd.uniform(-10, 200), rnd.uniform(-10, 200)
+        expected = pick_at(x, y)
+        assert snapshot.pick(x, y) is (expected[0] if expected else None)
+        assert snapshot.collide(x, y) == pick_at(x, y, True)
+
+    for _ in range(50):
+        left, bottom = rnd.uniform(-10, 200), rnd.uniform(-10, 200)
+        right, top = left + rnd.uniform(0, 50), bottom + rnd.uniform(0, 50)
+        expected = []
+        for widget in snapshot._widgets(range(len(snapshot))):
+            x1, y1, x2, y2 = widget_bounds(widget)
+            if x1 <= right and left <= x2 and y1 <= top and bottom <= y2 \
+                    and visible_chain(widget):
+                expected.append(widget)
+        assert snapshot.overlap(left, bottom, right, top) == expected
+
+
+def test_empty_window(window):
+    snapshot = spatial.SpatialSnapshot(window)
+    assert len(snapshot) == 0
+    assert snapshot.pick(0, 0) is None
+    assert snapshot.collide(0, 0) == []
+
+
+def test_index_rebuilds_when_invalidated(window):
+    window.add_widget(Widget())
+    index = spatial.SpatialIndex()
+    snapshot = index.snapshot()
+    assert index.snapshot() is snapshot
+    index._invalidate()
+    assert index.snapshot() is not snapshot
+    assert index.builds == 2
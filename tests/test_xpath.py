@@ -0,0 +1,211 @@
+# coding=utf-8
+"""
+Differential check of the selector evaluation against the semantics of the
+original implementation, on random trees: each step gives the widgets the
+original, recursive step gave, each widget once and in document order.
+"""
+
+import json
+import random
+import pytest
+from ncis_kivy.index import WidgetIndex
+from ncis_kivy.xpath import (
+    XpathParser, SequenceSelector, AllClassSelector, ChildrenClassSelector,
+    IndexSelector, AttrExistSelector, AttrOpSelector)
+
+
+class Widget(object):
+    _uid = 0
+
+    def __init__(self, **kwargs):
+        super(Widget, self).__init__()
+        self.parent = None
+        self.children = []
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def add_widget(self, widget, index=0):
+        widget.parent = self
+        self.children.insert(index, widget)
+
+    def fbind(self, name, callback):
+        Widget._uid += 1
+        return Widget._uid
+
+    def unbind_uid(self, name, uid):
+        pass
+
+
+class Layout(Widget):
+    pass
+
+
+class BoxLayout(Layout):
+    pass
+
+
+class GridLayout(Layout):
+    pass
+
+
+class Label(Widget):
+    pass
+
+
+class Button(Label):
+    pass
+
+
+class TextInput(Widget):
+    pass
+
+
+CLASSES = (BoxLayout, GridLayout, Label, Button, TextInput)
+NAMES = ("BoxLayout", "GridLayout", "Label", "Button", "TextInput",
+         "~Layout", "~Label", "~Widget", "Missing")
+TEXTS = ("", "ok", "cancel", "okay")
+
+
+def random_tree(rnd, size):
+    root = BoxLayout()
+    nodes = [root]
+    for _ in range(size):
+        parent = rnd.choice(nodes)
+        kwargs = {}
+        if rnd.random() < .5:
+            kwargs["text"] = rnd.choice(TEXTS)
+        if rnd.random() < .2:
+            kwargs["disabled"] = rnd.random() < .5
+        widget = rnd.choice(CLASSES)(**kwargs)
+        parent.add_widget(widget, rnd.randint(0, len(parent.children)))
+        nodes.append(widget)
+    return root
+
+
+def random_expr(rnd):
+    steps = []
+    for _ in range(rnd.randint(1, 4)):
+        steps.append(rnd.choice(("//", "/")) + rnd.choice(NAMES))
+        roll = rnd.random()
+        if roll < .2:
+            steps.append("[{}]".format(rnd.randint(0, 4)))
+        elif roll < .35:
+            steps.append(rnd.choice(("[@text]", "[@disabled]")))
+        elif roll < .55:
+            steps.append("[@text{}{}]".format(
+                rnd.choice(("=", "!=", "~=", "!~=")),
+                json.dumps(rnd.choice(TEXTS))))
+        elif roll < .6:
+            steps.append('[@text~="ok",@disabled=false]')
+    return "".join(steps)
+
+
+# the original implementation, one step at a time
+
+def traverse_tree(root):
+    yield root
+    for child in root.children:
+        for result in traverse_tree(child):
+            yield result
+
+
+def get_bases(cls):
+    for base in cls.__bases__:
+        if base.__name__ == 'object':
+            break
+        yield base
+        if base.__name__ == 'Widget':
+            break
+        for cbase in get_bases(base):
+            yield cbase
+
+
+def match_class(widget, classname):
+    if not classname.startswith("~"):
+        return widget.__class__.__name__ == classname
+    bases = [widget.__class__] + list(get_bases(widget.__class__))
+    return classname[1:] in [cls.__name__ for cls in bases]
+
+
+def baseline_step(selector, items):
+    if isinstance(selector, AllClassSelector):
+        return [match for item in items for match in traverse_tree(item)
+                if match_class(match, selector.classname)]
+    if isinstance(selector, ChildrenClassSelector):
+        return [child for item in items for child in item.children
+                if match_class(child, selector.classname)]
+    if isinstance(selector, IndexSelector):
+        return [item for index, item in enumerate(reversed(items))
+                if index == selector.index]
+    if isinstance(selector, AttrExistSelector):
+        return [item for item in items if hasattr(item, selector.attr)]
+    if isinstance(selector, AttrOpSelector):
+        value = json.loads(selector.value)
+        ops = {
+            "=": lambda item_value: item_value == value,
+            "!=": lambda item_value: item_value != value,
+            "~=": lambda item_value: value in item_value,
+            "!~=": lambda item_value: value not in item_value,
+        }
+        return [item for item in items if hasattr(item, selector.attr) and
+                ops[selector.op](getattr(item, selector.attr))]
+    raise TypeError(selector)
+
+
+def steps(selector):
+    if isinstance(selector, SequenceSelector):
+        return steps(selector.first) + steps(selector.second)
+    return [selector]
+
+
+def expected_matches(expr, root):
+    order = {id(widget): position
+             for position, widget in enumerate(traverse_tree(root))}
+    items = [root]
+    for selector in steps(XpathParser().parse(expr)):
+        matches = {id(item): item for item in baseline_step(selector, items)}
+        items = sorted(matches.values(), key=lambda item: order[id(item)])
+    return items
+
+
+def test_sample_tree():
+    root = BoxLayout()
+    inner = BoxLayout()
+    root.add_widget(Button(text="World"))
+    root.add_widget(Button(text="Hello"))
+    root.add_widget(inner)
+    inner.add_widget(TextInput())
+    nested = BoxLayout()
+    inner.add_widget(nested, 1)
+    nested.add_widget(Button(text="World"))
+    parser = XpathParser()
+
+    # nested matches, each Button once
+    matches = parser.parse("//BoxLayout//Button").execute(root)
+    assert matches == [nested.children[0]] + root.children[1:]
+    matches = parser.parse('//BoxLayout/Button[@text="World"]').execute(root)
+    assert matches == [nested.children[0], root.children[2]]
+    matches = parser.parse("//~Widget[0]").execute(root)
+    assert matches == [root.children[2]]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_trees(seed):
+    rnd = random.Random(seed)
+    root = random_tree(rnd, rnd.randint(1, 200))
+    index = WidgetIndex(root, debug=True)
+    # looks up even the classes too common for the index to help
+    lookup_all = WidgetIndex(root, debug=True)
+    lookup_all.LOOKUP_MAX_FRACTION = 1.
+    parser = XpathParser()
+    for _ in range(50):
+        expr = random_expr(rnd)
+        expected = expected_matches(expr, root)
+        selector = parser.parse(expr)
+        assert selector.execute(root) == expected, expr
+        assert selector.execute(root, index=index) == expected, expr
+        assert selector.execute(root, index=lookup_all) == expected, expr
+        assert selector.execute(root, limit=2) == expected[:2], expr
+        first = expected[0] if expected else None
+        assert selector.select_first(root, index=index) is first, expr
+    assert index.inconsistencies == lookup_all.inconsistencies == 0